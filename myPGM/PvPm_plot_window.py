@@ -1,7 +1,9 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import pyqtgraph as pg
 
-from PyQt5.QtWidgets import (QMainWindow,)
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import (QMainWindow, QAction)
 
 class PmPPlotWindow(QMainWindow):
 	def __init__(self, HPDataTable_, calibrations_):
@@ -24,6 +26,17 @@ class PmPPlotWindow(QMainWindow):
 		self.data = HPDataTable_
 		self.calibrations = calibrations_
 		self.lines = {}
+		# dashed curves of the pressures given by every compatible calibration
+		self.compare_lines = {}
+
+		toolbar = self.addToolBar("Plot")
+		self.compare_action = QAction("Compare calibrations", self)
+		self.compare_action.setCheckable(True)
+		self.compare_action.setToolTip(
+			"Also plot the pressure of every row with each calibration of the same "
+			"x (dashed)")
+		self.compare_action.toggled.connect(lambda checked: self.updatecomparison())
+		toolbar.addAction(self.compare_action)
 
 		self.updateplot()
 
@@ -34,16 +47,44 @@ class PmPPlotWindow(QMainWindow):
 		for g in groups:
 			subdf = gr.get_group(g)
 			if g in list(self.lines.keys()):
-				self.lines[g].setData(list(subdf['Pm']), list(subdf['P']))
+				self.lines[g].setData(subdf['Pm'].to_numpy(), subdf['P'].to_numpy())
 				
 			else :
 				self.pens[g] = pg.mkPen(color=self.calibrations[g].color)
 				self.lines[g] = self.plot_graph.plot(
-					list(subdf['Pm']),
-					list(subdf['P']),
+					subdf['Pm'].to_numpy(),
+					subdf['P'].to_numpy(),
 					name=g,
 					pen=self.pens[g],
 					symbol="o",
 					symbolSize=8,
 					symbolBrush=self.calibrations[g].color,)
 
+		self.updatecomparison()
+
+	def updatecomparison(self):
+		if not self.compare_action.isChecked():
+			for line in self.compare_lines.values():
+				self.plot_graph.removeItem(line)
+			self.compare_lines = {}
+			return
+
+		calibs = list(self.calibrations.values())
+		Pm = self.data.column('Pm')
+		matrix = self.data.pressure_matrix(calibs)
+		for j, c in enumerate(calibs):
+			# rows in table order, as the curves of updateplot
+			rows = np.isfinite(matrix[:, j])
+			if not rows.any():
+				if c.name in self.compare_lines:
+					self.plot_graph.removeItem(self.compare_lines.pop(c.name))
+				continue
+			if c.name in self.compare_lines:
+				self.compare_lines[c.name].setData(Pm[rows], matrix[rows, j])
+			else:
+				self.compare_lines[c.name] = self.plot_graph.plot(
+					Pm[rows],
+					matrix[rows, j],
+					name=c.name + " (all rows)",
+					pen=pg.mkPen(color=c.color, style=Qt.DashLine),)
+
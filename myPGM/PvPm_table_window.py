@@ -1,4 +1,5 @@
 import pandas as pd
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import (
     QWidget,
     QVBoxLayout,
@@ -56,16 +57,18 @@ class HPTableWidget(QTableWidget):
             pass
 
     def updatetable(self):
-        nrows, ncols = self.data.df.shape
+        df = self.data.df
+        nrows, ncols = df.shape
         self.setRowCount(nrows)
 
         # Absolutely necessary to disconnect otherwise infinite loop
         self.cellChanged[int, int].disconnect()
 
+        values = df.values
         for irow in range(self.rowCount()):
             for icol in range(self.columnCount()):
                 # print round() values in table
-                v = self.data.df.iloc[irow, icol]
+                v = values[irow, icol]
                 if isinstance(v, (int, float)):
                     s = str(round(v, 3))
                 else:
@@ -75,6 +78,9 @@ class HPTableWidget(QTableWidget):
 
         self.cellChanged[int, int].connect(self.getfromentry)
 
+    def selected_rows(self):
+        return sorted({index.row() for index in self.selectedIndexes()})
+
     def remove_line(self):
         index = self.currentRow()
         if index >= 0:
@@ -82,6 +88,9 @@ class HPTableWidget(QTableWidget):
 
 
 class HPTableWindow(QWidget):
+    # rows (all of them if none is selected) to set to the toolbox calibration and reference
+    referenceRequested = pyqtSignal(object)
+
     def __init__(self, HPDataTable_, calibrations_):
         super().__init__()
 
@@ -103,8 +112,18 @@ class HPTableWindow(QWidget):
 
         self.table_save_csv_button = QPushButton("Save data to csv")
         self.table_load_csv_button = QPushButton("Load data from csv")
+        self.table_reference_button = QPushButton("Apply toolbox reference")
+        self.table_reference_button.setToolTip(
+            "Set the calibration, x0, T0 and T of the toolbox to the selected rows "
+            "(all rows if none is selected) and recompute their pressure")
+        self.table_compare_button = QPushButton("Export calibration comparison")
+        self.table_compare_button.setToolTip(
+            "Save to csv the pressure of every row with each calibration of the same x "
+            "(empty where a calibration does not apply)")
         table_actions_layout.addWidget(self.table_save_csv_button)
         table_actions_layout.addWidget(self.table_load_csv_button)
+        table_actions_layout.addWidget(self.table_reference_button)
+        table_actions_layout.addWidget(self.table_compare_button)
 
         layout.addLayout(table_actions_layout)
 
@@ -112,6 +131,9 @@ class HPTableWindow(QWidget):
 
         self.table_save_csv_button.clicked.connect(self.save_data_to_csv)
         self.table_load_csv_button.clicked.connect(self.load_data_from_csv)
+        self.table_compare_button.clicked.connect(self.save_comparison_to_csv)
+        self.table_reference_button.clicked.connect(
+            lambda: self.referenceRequested.emit(self.table_widget.selected_rows() or None))
 
         # save_shortcut = QShortcut(QKeySequence("Ctrl+S"), self)
         # load_shortcut = QShortcut(QKeySequence("Ctrl+O"), self)
@@ -123,6 +145,20 @@ class HPTableWindow(QWidget):
         if file:
             self.data.df.to_csv(file, sep="\t", decimal=".", header=True, index=False)
 
+    def comparison_df(self):
+        ''' Rows of the table with one pressure column per calibration '''
+        calibs = list(self.calibrations.values())
+        df = self.data.df[["Pm", "x", "T", "x0", "T0", "calib", "file"]]
+        matrix = self.data.pressure_matrix(calibs)
+        return pd.concat([df, pd.DataFrame(matrix, columns=[c.name for c in calibs])], 
+                         axis=1)
+
+    def save_comparison_to_csv(self):
+        file = self.get_save_filename_dialog()
+        if file:
+            self.comparison_df().to_csv(file, sep="\t", decimal=".", header=True, 
+                                        index=False)
+
     def load_data_from_csv(self):
         file = self.get_load_filename_dialog()
         if file:
@@ -0,0 +1,202 @@
+''' Headless batch fitting of spectrum files
+
+Usage (from the repository or the myPGM folder):
+
+    python -m myPGM.batch data/run1 --model "Double Voigt" --calib Ruby2020 -o run1.csv
+    python batch.py "data/run1/*.asc" --model "Single Voigt" --calib "Samarium SrB4O7 Datchi 1997" --bg
+
+The output is the same tab separated table as the "Save data to csv" button
+of the PvPm table window.
+'''
+import os
+import sys
+import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+# modules of this folder are imported as top level modules, as in start.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import pandas as pd
+from scipy.ndimage import uniform_filter1d
+
+import core
+from fit_models import model_list
+from calibrations import calib_list
+
+FILE_EXTENSIONS = ('.asc', '.txt')
+
+
+def list_files(inputs):
+    files = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            files += sorted(os.path.join(inp, f) for f in os.listdir(inp)
+                            if f.lower().endswith(FILE_EXTENSIONS))
+        else:
+            files += sorted(glob.glob(inp))
+    return files
+
+
+def load_file(path, subtract_bg, smoothing):
+    ''' Load, smooth and background steps of fit_file '''
+    item = core.load_spectrum(path)
+    x, y = item.x, item.y
+    if smoothing > 1:
+        y = uniform_filter1d(y, size=int(smoothing))
+    if subtract_bg:
+        y = y - core.convex_hull_bg(x, y)
+    return item.name, x, y
+
+
+def fit_file(path, model_name, calib_name, x0, T0, T, subtract_bg, smoothing, window=None, 
+             binning=1):
+    ''' Same steps as in the GUI: load, smooth, background, fit and pressure '''
+    model = {m.name: m for m in model_list}[model_name]
+    calib = {c.name: c for c in calib_list}[calib_name]
+
+    name, x, y = load_file(path, subtract_bg, smoothing)
+    _, best_x = core.fit_spectrum(model, x, y, window=window, binning=binning)
+
+    point = core.HPData(Pm=0, P=0, x=best_x, T=T, x0=x0, T0=T0,
+                            calib=calib, file=name)
+    point.calcP()
+    return point
+
+
+def _load_file_or_error(args):
+    try:
+        return load_file(*args), None
+    except Exception as e:
+        return None, '{}: {}'.format(os.path.basename(args[0]), e)
+
+
+def fit_files_stacked(executor, files, model_name, calib_name, x0, T0, T, 
+                      subtract_bg, smoothing, window=None):
+    ''' Spectra sharing their x axis are fitted together by core.fit_spectra,
+    results and errors in file order '''
+    model = {m.name: m for m in model_list}[model_name]
+    calib = {c.name: c for c in calib_list}[calib_name]
+
+    loaded = list(executor.map(_load_file_or_error, 
+                               [(f, subtract_bg, smoothing) for f in files],
+                               chunksize=max(1, len(files) // 64)))
+    results = [(None, error) for _, error in loaded]
+    groups = {}
+    for i, (spectrum, _) in enumerate(loaded):
+        if spectrum is not None:
+            x = core.intern_axis(spectrum[1])
+            groups.setdefault(id(x), (x, []))[1].append(i)
+
+    for x, rows in groups.values():
+        Y = np.array([loaded[i][0][2] for i in rows])
+        try:
+            res, best_x = core.fit_spectra(model, x, Y, window=window)
+        except Exception as e:
+            for i in rows:
+                results[i] = None, '{}: {}'.format(loaded[i][0][0], e)
+            continue
+        pressures = calib.P(best_x, T, x0, T0)
+        for i, converged, nfev, bx, P in zip(rows, res["converged"], res["nfev"], best_x, 
+                                             pressures):
+            name = loaded[i][0][0]
+            if not converged:
+                reason = 'fit did not converge' if nfev else 'no initial parameters found'
+                results[i] = None, '{}: {}'.format(name, reason)
+                continue
+            results[i] = core.HPData(Pm=0, P=P, x=bx, T=T, x0=x0, T0=T0, 
+                                     calib=calib, file=name), None
+    return results
+
+
+def _fit_file_or_error(args):
+    try:
+        return fit_file(*args), None
+    except Exception as e:
+        return None, '{}: {}'.format(os.path.basename(args[0]), e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='myPGM.batch',
+                                     description='Fit spectrum files without the GUI.')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories, files or glob patterns')
+    parser.add_argument('-m', '--model', required=True,
+                        choices=[m.name for m in model_list])
+    parser.add_argument('-c', '--calib', required=True,
+                        choices=[c.name for c in calib_list])
+    parser.add_argument('--x0', type=float, default=None,
+                        help='reference position (default: calibration default)')
+    parser.add_argument('--T0', type=float, default=298)
+    parser.add_argument('--T', type=float, default=298)
+    parser.add_argument('--bg', action='store_true',
+                        help='subtract the convex hull background (Auto Bg)')
+    parser.add_argument('--smoothing', type=int, default=1)
+    parser.add_argument('--window', type=float, nargs=2, metavar=('XMIN', 'XMAX'),
+                        default=None, help='fit only this x range')
+    parser.add_argument('--auto-window', action='store_true',
+                        help='fit only around the peaks found in each spectrum')
+    parser.add_argument('--binning', type=int, default=1,
+                        help='first fit the spectra binned by this factor, then refine '
+                             'at full resolution')
+    parser.add_argument('--stacked', action='store_true',
+                        help='fit all the spectra sharing their x axis at once '
+                             '(peak models only, faster on long series)')
+    parser.add_argument('--fit-cache', action='store_true',
+                        help='keep the fit results on disk, unchanged spectra are '
+                             'not fitted again on the next run')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file (default: standard output)')
+    args = parser.parse_args(argv)
+
+    files = list_files(args.inputs)
+    if not files:
+        parser.error('no file found')
+
+    x0 = args.x0
+    if x0 is None:
+        x0 = {c.name: c for c in calib_list}[args.calib].x0default
+
+    if args.fit_cache:
+        # read by core in the worker processes
+        os.environ['MYPGM_FIT_CACHE'] = '1'
+        core.fit_cache.persistent = True
+
+    window = 'auto' if args.auto_window else args.window
+    if args.stacked:
+        if {m.name: m for m in model_list}[args.model].type != 'peak':
+            parser.error('--stacked needs a peak model')
+        if window == 'auto':
+            parser.error('--stacked needs a fixed --window')
+        if args.binning > 1:
+            parser.error('--stacked does not support --binning')
+
+    jobs = [(f, args.model, args.calib, x0, args.T0, args.T, args.bg, args.smoothing, window,
+             args.binning) for f in files]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # results come back in file order
+        if args.stacked:
+            results = fit_files_stacked(executor, files, args.model, args.calib, x0, 
+                                        args.T0, args.T, args.bg, args.smoothing, window)
+        else:
+            results = list(executor.map(_fit_file_or_error, jobs,
+                                        chunksize=max(1, len(jobs) // 64)))
+
+    points = [p for p, _ in results if p is not None]
+    for _, error in results:
+        if error is not None:
+            print('Fit failed for ' + error, file=sys.stderr)
+
+    if not points:
+        return 1
+    df = pd.concat([p.df for p in points], ignore_index=True)
+    df.to_csv(args.output if args.output else sys.stdout,
+              sep="\t", decimal=".", header=True, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
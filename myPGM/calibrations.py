@@ -1,6 +1,14 @@
-import helpers
+import core
 import numpy as np
 
+
+# Inverse functions: P = a1*r + a2*r**2 solved for the root going through r(0) = 0,
+# written 2P / (a1 + sqrt(a1**2 + 4*a2*P)) to avoid cancellation at low pressure
+def _quadratic_root(P, a1, a2):
+    with np.errstate(invalid='ignore'):
+        return 2*P / (a1 + np.sqrt(a1**2 + 4*a2*P))
+
+
 # Shen G., Wang Y., Dewaele A. et al. (2020) High Pres. Res. doi: 10.1080/08957959.2020.1791107
 def Pruby2020(l, T, l0, T0):
     dT = T - T0
@@ -10,19 +18,28 @@ def Pruby2020(l, T, l0, T0):
 
     return P
 
+def lruby2020(P, T, l0, T0):
+    dT = T - T0
+    dlcorr = 0.00746 * dT - 3.01e-6 * dT**2 + 8.76e-9 * dT**3
+    return l0 * (1 + _quadratic_root(P, 1870, 1870 * 5.63)) + dlcorr
+
 #  F. Datchi, High Pressure Research, 27:4, 447-463, DOI: 10.1080/08957950701659593 
+def _dlcorr_sam(T, T0):
+    # dT = T - T0
+    # dlcorr = -8.7e-5 * dT + 4.62e-6 * dT**2 -2.38e-9 * dT**3    # problem here !? (Datchi HPR 2007)
+    T = np.asarray(T, dtype=float)
+    return np.where(T >= 500, 1.06e-4 * (T-500) + 1.5e-7 * (T-500)**2, 0)    # these Queyroux p. 68
+
 def PsamDatchi1997(l, T, l0, T0):
-    dT = T - T0
-    dlcorr = -8.7e-5 * dT + 4.62e-6 * dT**2 -2.38e-9 * dT**3    # problem here !? (Datchi HPR 2007)
-    if T >= 500:
-        dlcorr = 1.06e-4 * (T-500) + 1.5e-7 * (T-500)**2    # these Queyroux p. 68
-    else:
-        dlcorr = 0
-    #dlcorr=0
+    dlcorr = _dlcorr_sam(T, T0)
     dl = (l-dlcorr) - l0
     P = 4.032 * dl * (1 + 9.29e-3 * dl) / (1 + 2.32e-2 * dl)
     return P
 
+def lsamDatchi1997(P, T, l0, T0):
+    dl = _quadratic_root(P, 4.032 - 2.32e-2 * np.asarray(P), 4.032 * 9.29e-3)
+    return l0 + dl + _dlcorr_sam(T, T0)
+
 #  F. Datchi, High Pressure Research, 27:4, 447-463, DOI: 10.1080/08957950701659593 
 def PcBN(nu, T, nu0, T0):
     # find nu(p = 0 GPa, T = 0 K)
@@ -34,6 +51,14 @@ def PcBN(nu, T, nu0, T0):
     P = (B0_T/B0p) * ( (nu/nu0_T)**2.876 - 1 )
     return P
 
+def nucBN(P, T, nu0, T0):
+    nu00 = nu0 + 0.0091 * T0 + 1.54e-5 * T0**2
+    nu0_T = nu00 - 0.0091 * T - 1.54e-5 * T**2
+    B0_T = 396.5 - 0.0288 * (T - 300) - 6.84e-6 * (T - 300)**2
+    B0p = 3.62
+    with np.errstate(invalid='ignore'):
+        return nu0_T * (1 + P * B0p/B0_T)**(1/2.876)
+
 # AKAHAMA, KAWAMURA, JOURNAL OF APPLIED PHYSICS 100, 043516 2006
 def PAkahama2006(nu, T, nu0, T0):
     K0  = 547 # GPa
@@ -42,6 +67,11 @@ def PAkahama2006(nu, T, nu0, T0):
     p = K0 * (dnu/nu0) * (1 + 0.5 * (K0p -1)*dnu/nu0)
     return p 
 
+def nuAkahama2006(P, T, nu0, T0):
+    K0  = 547
+    K0p = 3.75
+    return nu0 * (1 + _quadratic_root(P, K0, K0 * 0.5 * (K0p - 1)))
+
 
 # Eremets et al., Nat Commun 14, 907 (2023). https://doi.org/10.1038/s41467-023-36429-9
 def PEremets2023(nu, T, nu0, T0):
@@ -51,6 +81,9 @@ def PEremets2023(nu, T, nu0, T0):
     p = A * (dnu/nu0) + B * (dnu/nu0)**2
     return p 
 
+def nuEremets2023(P, T, nu0, T0):
+    return nu0 * (1 + _quadratic_root(P, 517, 764))
+
 
 def PHilberer2025(nu, T, nu0, T0):
     K0  = 576.521119539528 # GPa
@@ -59,20 +92,29 @@ def PHilberer2025(nu, T, nu0, T0):
     p = K0 * (dnu/nu0) * (1 + 0.5 * (K0p -1)*dnu/nu0)
     return p
 
+def nuHilberer2025(P, T, nu0, T0):
+    K0  = 576.521119539528
+    K0p = 3.2571168198326683
+    return nu0 * (1 + _quadratic_root(P, K0, K0 * 0.5 * (K0p - 1)))
+
 # Homemade:
-def H2_Vibron(nu, T=0, nu0=0, T0=0):
-    f = np.polynomial.polynomial.Polynomial(
+# evaluated in a variable scaled to [-1, 1] over 4000-4300 cm-1, the raw
+# coefficients cancel each other to ~1e-5 GPa
+_H2_VIBRON = np.polynomial.polynomial.Polynomial(
         (-14536565712.17933,
          +17309734.53397923,
          -8244.669967044751,
          +1.963452944114722,
          -0.0002337933432834734,
-          1.113520628648027e-08))
-    return f(nu)
+          1.113520628648027e-08)).convert(domain=[4000, 4300])
+
+def H2_Vibron(nu, T=0, nu0=0, T0=0):
+    return _H2_VIBRON(nu) + np.zeros(np.broadcast(T, nu0, T0).shape)
 
 
-Ruby2020 = helpers.HPCalibration(name = 'Ruby2020',
+Ruby2020 = core.HPCalibration(name = 'Ruby2020',
                                  func = Pruby2020,
+                                 inverse = lruby2020,
                                  Tcor_name='Datchi 2007',
                                  xname = 'lambda',
                                  xunit = 'nm',
@@ -80,8 +122,9 @@ Ruby2020 = helpers.HPCalibration(name = 'Ruby2020',
                                  xstep = .01,
                                  color = 'firebrick')
         
-SamariumDatchi = helpers.HPCalibration(name = 'Samarium SrB4O7 Datchi 1997',
+SamariumDatchi = core.HPCalibration(name = 'Samarium SrB4O7 Datchi 1997',
                                        func = PsamDatchi1997,
+                                       inverse = lsamDatchi1997,
                                        Tcor_name='Datchi 2007 (?)',
                                        xname = 'lambda',
                                        xunit = 'nm',
@@ -89,8 +132,9 @@ SamariumDatchi = helpers.HPCalibration(name = 'Samarium SrB4O7 Datchi 1997',
                                        xstep = .01,
                                        color = 'mediumseagreen')
 
-Hilberer2025 = helpers.HPCalibration(name = 'Diamond Raman Edge Hilberer 2025',
+Hilberer2025 = core.HPCalibration(name = 'Diamond Raman Edge Hilberer 2025',
                                     func = PHilberer2025,
+                                    inverse = nuHilberer2025,
                                     Tcor_name='NA',
                                     xname = 'nu',
                                     xunit = 'cm-1',
@@ -98,8 +142,9 @@ Hilberer2025 = helpers.HPCalibration(name = 'Diamond Raman Edge Hilberer 2025',
                                     xstep = .1,
                                     color = 'orangered')
 
-Akahama2006 = helpers.HPCalibration(name = 'Diamond Raman Edge Akahama 2006',
+Akahama2006 = core.HPCalibration(name = 'Diamond Raman Edge Akahama 2006',
                                     func = PAkahama2006,
+                                    inverse = nuAkahama2006,
                                     Tcor_name='NA',
                                     xname = 'nu',
                                     xunit = 'cm-1',
@@ -107,8 +152,9 @@ Akahama2006 = helpers.HPCalibration(name = 'Diamond Raman Edge Akahama 2006',
                                     xstep = .1,
                                     color = 'darkgrey')
 
-Eremets2023 = helpers.HPCalibration(name = 'Diamond Raman Edge Eremets 2023',
+Eremets2023 = core.HPCalibration(name = 'Diamond Raman Edge Eremets 2023',
                                     func = PEremets2023,
+                                    inverse = nuEremets2023,
                                     Tcor_name='NA',
                                     xname = 'nu',
                                     xunit = 'cm-1',
@@ -116,8 +162,9 @@ Eremets2023 = helpers.HPCalibration(name = 'Diamond Raman Edge Eremets 2023',
                                     xstep = .1,
                                     color = 'steelblue')
         
-cBNDatchi = helpers.HPCalibration(name = 'cBN Raman Datchi 2007',
+cBNDatchi = core.HPCalibration(name = 'cBN Raman Datchi 2007',
                                   func = PcBN,
+                                  inverse = nucBN,
                                   Tcor_name='Datchi 2007',
                                   xname = 'nu',
                                   xunit = 'cm-1',
@@ -125,8 +172,9 @@ cBNDatchi = helpers.HPCalibration(name = 'cBN Raman Datchi 2007',
                                   xstep = .1,
                                   color = 'lightblue')
 
-H2Vibron = helpers.HPCalibration(name = 'H2 Vibron <30GPa',
+H2Vibron = core.HPCalibration(name = 'H2 Vibron <30GPa',
                                   func = H2_Vibron,
+                                  xrange = (4150, 4270),
                                   Tcor_name='NA',
                                   xname = 'nu',
                                   xunit = 'cm-1',
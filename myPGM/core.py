@@ -0,0 +1,1600 @@
+# Numerical core of myPGM: no Qt here so that it can be imported quickly
+# by worker processes and headless runs. Heavy scipy and pandas modules
+# are imported where they are needed.
+import numpy as np
+from copy import deepcopy
+from inspect import getfullargspec
+import csv
+import os
+import hashlib
+import json
+import atexit
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+
+
+DELIMITERS = ('\t', ',', ';', ' ')
+
+
+def _sniff_delimiter(file):
+    # Skip initial lines to determine the delimiter
+    initial_skip = 100  
+    for _ in range(initial_skip):
+        file.readline()
+
+    # Read a chunk from the middle of the file to determine the delimiter
+    chunk_size = 2000
+    chunk = file.read(chunk_size)
+    file.seek(0)  # Reset file pointer to the beginning
+
+    # Usual delimiters are checked first on a few complete lines, the
+    # csv Sniffer is much slower and only used when none of them fits
+    sample = chunk.splitlines()[1:-1][:20]
+    best, best_count = None, 0
+    for delimiter in DELIMITERS:
+        count = sum(_is_data_line(line, delimiter) for line in sample)
+        if count > best_count:
+            best, best_count = delimiter, count
+    if best is not None:
+        return best
+
+    return csv.Sniffer().sniff(chunk).delimiter
+
+
+def _is_data_line(line, delimiter):
+    sp = line.strip().split(delimiter)
+    if len(sp) < 2:
+        return False
+    try:
+        for s in sp:
+            float(s)
+    except ValueError:
+        return False
+    return True
+
+
+def _parse_data_lines(lines, delimiter):
+    # Slow path: check every line, header and footer are exluded
+    # as well as any non numeric line in the middle of the data
+    data_lines = [line.strip().split(delimiter) for line in lines 
+                  if _is_data_line(line, delimiter)]
+    return np.array(data_lines, dtype=np.float64)
+
+
+class SpectrumCache():
+    ''' Parsed spectra stored as .npy blobs, keyed by path, size and mtime '''
+    def __init__(self, directory, max_size=500e6, enabled=True):
+        self.directory = directory
+        self.max_size = max_size    # bytes, least recently used blobs go first
+        self.enabled = enabled
+        self._size = None           # total size of the blobs, computed once
+
+    def __repr__(self):
+        return 'SpectrumCache : ' + str( self.__dict__ )
+
+    def blob_path(self, f):
+        st = os.stat(f)
+        key = '{}|{}|{}'.format(os.path.abspath(f), st.st_size, st.st_mtime_ns)
+        return os.path.join(self.directory, 
+                            hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def load(self, f):
+        return self.load_blob(self.blob_path(f))
+
+    def store(self, f, data):
+        self.store_blob(self.blob_path(f), data)
+
+    def load_blob(self, blob):
+        try:
+            data = np.load(blob)
+        except (OSError, ValueError):
+            return None
+        # blob mtime is used as last access time for the LRU eviction,
+        # best effort: the cache directory may be read-only or shared
+        try:
+            os.utime(blob)
+        except OSError:
+            pass
+        return data
+
+    def store_blob(self, blob, data):
+        tmp = blob + '.tmp{}'.format(os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp, 'wb') as file:
+                np.save(file, data)
+            os.replace(tmp, blob)   # never leaves a partial blob
+        except OSError:
+            return
+        if self._size is not None:
+            self._size += os.path.getsize(blob)
+        self.evict()
+
+    def _blobs(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) 
+                       if e.name.endswith('.npy')]
+        except OSError:
+            return []
+        return [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+
+    def evict(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._blobs())
+        if self._size <= self.max_size:
+            return
+        blobs = sorted(self._blobs())
+        self._size = sum(size for _, size, _ in blobs)
+        for _, size, path in blobs:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, path in self._blobs():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
+
+
+# Set MYPGM_NO_CACHE=1 or spectrum_cache.enabled = False to turn the cache off
+spectrum_cache = SpectrumCache(
+    directory=os.environ.get('MYPGM_CACHE_DIR', 
+        os.path.join(os.environ.get('XDG_CACHE_HOME', 
+                                    os.path.expanduser('~/.cache')), 
+                     'myPGM', 'spectra')),
+    enabled=not os.environ.get('MYPGM_NO_CACHE'))
+
+
+class FitCache():
+    ''' Results of fit_spectrum keyed by the fitted data, the model name, the
+    fit window and the initial guess. The max_entries last results are kept
+    in memory, with persistent they are also stored as .npy blobs in a
+    SpectrumCache directory '''
+    FORMAT = 2  # layout of the stored results, part of the keys
+
+    def __init__(self, directory, max_entries=1000, max_size=50e6, persistent=False, 
+                 enabled=True):
+        self.blobs = SpectrumCache(directory, max_size)
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self._lru = OrderedDict()   # key -> (fit result, gauge position)
+        self._lock = threading.Lock()   # fits also run in worker threads
+
+    def __repr__(self):
+        return 'FitCache : {} results in memory, persistent={}'.format(
+            len(self._lru), self.persistent)
+
+    @property
+    def directory(self):
+        return self.blobs.directory
+
+    @classmethod
+    def key(cls, model, x, y, window=None, guess_peak=None, p0=None, bounded=False, binning=1):
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(x, dtype=float).tobytes())
+        h.update(np.ascontiguousarray(y, dtype=float).tobytes())
+        if p0 is not None:
+            h.update(np.asarray(p0, dtype=float).tobytes())
+        if window is not None:
+            window = tuple(float(v) for v in window)
+        options = (cls.FORMAT, model.name, window, guess_peak, bounded)
+        if binning > 1:
+            options += (binning,)
+        h.update(repr(options).encode())
+        return h.hexdigest()
+
+    def blob_path(self, key):
+        return os.path.join(self.blobs.directory, key + '.npy')
+
+    @staticmethod
+    def _encode(res, best_x):
+        # one flat array: nfev, coarse_nfev, best_x, window, number of parameters, opti, cov
+        window = (np.nan, np.nan) if res["window"] is None else res["window"]
+        opti = np.asarray(res["opti"], dtype=float)
+        return np.concatenate(([res["nfev"], res.get("coarse_nfev", 0), best_x, 
+                                window[0], window[1], len(opti)], 
+                               opti, np.asarray(res["cov"], dtype=float).ravel()))
+
+    @staticmethod
+    def _decode(data):
+        n = int(data[5])
+        window = None if np.isnan(data[3]) else (float(data[3]), float(data[4]))
+        res = {"opti": data[6:6 + n], "cov": data[6 + n:].reshape(n, n),
+               "window": window, "nfev": int(data[0])}
+        if data[1]:
+            res["coarse_nfev"] = int(data[1])
+        return res, float(data[2])
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+        if entry is None and self.persistent:
+            data = self.blobs.load_blob(self.blob_path(key))
+            if data is not None:
+                entry = self._decode(data)
+                self._remember(key, entry)
+        if entry is None:
+            return None
+        # copies, callers add their own keys to the result
+        res, best_x = entry
+        return dict(res, opti=res["opti"].copy(), cov=res["cov"].copy()), best_x
+
+    def put(self, key, res, best_x):
+        data = self._encode(res, best_x)
+        self._remember(key, self._decode(data))
+        if self.persistent:
+            self.blobs.store_blob(self.blob_path(key), data)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._lru[key] = entry
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+        self.blobs.clear()
+
+
+# Set MYPGM_NO_CACHE=1 or fit_cache.enabled = False to turn the fit cache off,
+# MYPGM_FIT_CACHE=1 or fit_cache.persistent = True to keep the results on disk
+fit_cache = FitCache(
+    directory=os.path.join(os.path.dirname(spectrum_cache.directory), 'fits'),
+    persistent=bool(os.environ.get('MYPGM_FIT_CACHE')),
+    enabled=not os.environ.get('MYPGM_NO_CACHE'))
+
+
+def customparse_file2data(f, use_cache=True):
+    if use_cache and spectrum_cache.enabled:
+        data = spectrum_cache.load(f)
+        if data is None:
+            data = parse_file2data(f)
+            spectrum_cache.store(f, data)
+        return data
+    return parse_file2data(f)
+
+
+def parse_file2data(f):
+    with open(f, 'r') as file:
+        delimiter = _sniff_delimiter(file)
+        lines = file.read().splitlines()
+
+    # Find where the numeric block starts and ends, only header
+    # and footer lines are checked in python
+    start = 0
+    while start < len(lines) and not _is_data_line(lines[start], delimiter):
+        start += 1
+    stop = len(lines)
+    while stop > start and not _is_data_line(lines[stop - 1], delimiter):
+        stop -= 1
+
+    try:
+        # C-level parser on the numeric block
+        data = np.loadtxt(lines[start:stop], delimiter=delimiter, 
+                          dtype=np.float64, ndmin=2)
+    except ValueError:
+        # non numeric lines inside the block, check them one by one
+        data = _parse_data_lines(lines[start:stop], delimiter)
+
+    return data[:, :2]
+
+
+class SpectrumMemory():
+    ''' Least recently used arrays of the spectrum items under a memory budget.
+    Evicted arrays are re-read from their file when unchanged, 
+    otherwise spilled to a temporary directory '''
+    def __init__(self, budget=1e9):
+        self.budget = budget    # bytes
+        self.size = 0
+        self._lru = OrderedDict()   # (id(item), key) -> (weakref to item, nbytes)
+        self._lock = threading.RLock()  # items are also filled by worker threads
+        self._spill_directory = None
+        self._count = 0
+
+    def __repr__(self):
+        return 'SpectrumMemory : {:.1f} / {:.1f} MB in {} arrays'.format(
+            self.size/1e6, self.budget/1e6, len(self._lru))
+
+    def add(self, item, key, nbytes):
+        with self._lock:
+            self.remove(item, key)
+            self._lru[(id(item), key)] = (weakref.ref(item), nbytes)
+            self.size += nbytes
+            self.evict()
+
+    def touch(self, item, key):
+        with self._lock:
+            if (id(item), key) in self._lru:
+                self._lru.move_to_end((id(item), key))
+
+    def remove(self, item, key):
+        with self._lock:
+            entry = self._lru.pop((id(item), key), None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def evict(self):
+        with self._lock:
+            # the most recent array is always kept
+            while self.size > self.budget and len(self._lru) > 1:
+                (_, key), (ref, nbytes) = self._lru.popitem(last=False)
+                self.size -= nbytes
+                item = ref()
+                if item is not None:    # else it was deleted in the meantime
+                    item._evict(key)
+
+    def spill_path(self):
+        with self._lock:
+            if self._spill_directory is None:
+                self._spill_directory = tempfile.mkdtemp(prefix='myPGM-')
+                atexit.register(shutil.rmtree, self._spill_directory, True)
+            self._count += 1
+            return os.path.join(self._spill_directory, '{}.npy'.format(self._count))
+
+
+# Set MYPGM_MEMORY_BUDGET (MB) or spectrum_memory.budget to change the budget
+spectrum_memory = SpectrumMemory(
+    budget=float(os.environ.get('MYPGM_MEMORY_BUDGET', 1000)) * 1e6)
+
+
+_axes = weakref.WeakValueDictionary()   # digest -> shared x axis
+_axes_lock = threading.Lock()
+
+
+def intern_axis(x):
+    ''' Shared read-only array byte-identical to x, spectra recorded on 
+    the same spectrometer then hold a single copy of their axis '''
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    key = hashlib.blake2b(x, digest_size=16).digest()
+    with _axes_lock:
+        shared = _axes.get(key)
+        if shared is not None and shared.shape == x.shape and \
+                shared.tobytes() == x.tobytes():
+            return shared
+        if x.flags.writeable:
+            x = x.copy()    # never freeze an array owned by the caller
+        x.setflags(write=False)
+        _axes[key] = x
+        return x
+
+
+def _array_property(key):
+    return property(lambda self: self._get_array(key),
+                    lambda self, value: self._set_array(key, value))
+
+
+class _NotRead():
+    ''' _source of a lazy item whose file has not been read yet '''
+    def __repr__(self):
+        return '_NOT_READ'
+
+    def __reduce__(self):
+        return '_NOT_READ'  # pickled as a reference to the module constant
+
+
+_NOT_READ = _NotRead()
+
+
+def _normalize(y):
+    y -= np.min(y)
+    y /= np.max(y)
+
+
+class MySpectrumItem:
+    ''' Spectrum in the file list. x is a shared axis (see intern_axis), 
+    intensities are loaded on first access and can be evicted by 
+    spectrum_memory, only the metadata stays in memory '''
+    ARRAYS = ('y', 'corrected_y', 'bg')
+
+    y = _array_property('y')
+    corrected_y = _array_property('corrected_y')
+    bg = _array_property('bg')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self._x = None
+        self._arrays = {}       # resident arrays
+        self._spilled = {}      # evicted arrays written to disk
+        self._source = None     # (size, mtime) of path when y was read from it, or _NOT_READ
+        # eviction runs in whichever thread adds an array to spectrum_memory
+        self._lock = threading.RLock()
+        self.current_smoothing = None
+        self.fit_result = None
+        self.fit_toolbox_config = None
+        self.fit_model = None
+        self.fit_window = None  # (xmin, xmax) fitted range, None for the whole spectrum
+        self._fit_curve = None  # (fit result, grid, x, y) of the last fitted_curve
+
+    @property
+    def x(self):
+        if self._x is None and self._source is not None:
+            self._get_array('y')    # lazy item, x comes with the file
+        return self._x
+
+    @x.setter
+    def x(self, value):
+        self._x = None if value is None else intern_axis(value)
+
+    def get_xy(self):
+        ''' x and the corrected intensity, or the raw one if not corrected '''
+        y = self.corrected_y
+        if y is None:
+            y = self.y
+        return self.x, y
+
+    def fitted_curve(self, xrange=None, n_points=None):
+        ''' x and fitted peak model over the fit window, only its part in
+        xrange (visible range), on n_points evenly spaced points when that is
+        finer than the data. The last curve is kept until the fit changes '''
+        x = self.x
+        x = x[window_slice(x, self.fit_result.get("window"))]
+        x = x[window_slice(x, xrange)]
+        fine = len(x) > 1 and n_points is not None and n_points > len(x)
+        grid = (len(x), fine) + ((float(x[0]), float(x[-1])) if len(x) else ())
+        if (self._fit_curve is None or self._fit_curve[0] is not self.fit_result 
+                or self._fit_curve[1] != grid):
+            if fine:
+                x = np.linspace(x[0], x[-1], n_points)
+            y = self.fit_model.func(x, *self.fit_result["opti"])
+            self._fit_curve = (self.fit_result, grid, x, y)
+        return self._fit_curve[2], self._fit_curve[3]
+
+    # (N, 2) arrays as in the files, these are copies: prefer x and y
+    @property
+    def data(self):
+        y = self.y
+        return None if y is None else np.column_stack((self.x, y))
+
+    @data.setter
+    def data(self, value):
+        if value is None:
+            self.y = None
+        else:
+            self.x = value[:, 0]
+            self.y = np.ascontiguousarray(value[:, 1])
+
+    @property
+    def corrected_data(self):
+        y = self.corrected_y
+        return None if y is None else np.column_stack((self.x, y))
+
+    @corrected_data.setter
+    def corrected_data(self, value):
+        if value is None:
+            self.corrected_y = None
+        else:
+            if self._x is None:
+                self.x = value[:, 0]
+            self.corrected_y = np.ascontiguousarray(value[:, 1])
+
+    def normalize_data(self):
+        _normalize(self.y)
+
+    def load_data(self, lazy=False):
+        ''' Read and normalize the file, now or on first access to x or y '''
+        self.y = None
+        self._source = _NOT_READ
+        if not lazy:
+            self._get_array('y')
+
+    def _stat_source(self):
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime_ns)
+
+    # The item lock guards _arrays and _spilled, spectrum_memory is only
+    # called without it: its own lock is held while it evicts (item lock
+    # taken second), so the reverse order could deadlock
+    def _get_array(self, key):
+        with self._lock:
+            value = self._arrays.get(key)
+            if value is None:
+                value = self._read_array(key)
+                if value is None:
+                    return None
+                self._arrays[key] = value
+                added = True
+            else:
+                added = False
+        if added:
+            spectrum_memory.add(self, key, value.nbytes)
+        else:
+            spectrum_memory.touch(self, key)
+        return value
+
+    def _read_array(self, key):
+        # evicted array from its spill file, or y from the data file
+        if key in self._spilled:
+            spill = self._spilled.pop(key)
+            value = np.load(spill)
+            os.remove(spill)
+            return value
+        if key == 'y' and self._source is not None:
+            data = customparse_file2data(self.path)
+            self.x = data[:, 0]
+            value = np.ascontiguousarray(data[:, 1])
+            _normalize(value)
+            self._source = self._stat_source()
+            return value
+        return None
+
+    def _set_array(self, key, value):
+        with self._lock:
+            self._arrays.pop(key, None)
+            spill = self._spilled.pop(key, None)
+            if spill is not None:
+                os.remove(spill)
+            if key == 'y':
+                self._source = None     # not the file content anymore
+            if value is not None:
+                self._arrays[key] = value
+        spectrum_memory.remove(self, key)
+        if value is not None:
+            spectrum_memory.add(self, key, value.nbytes)
+
+    def _evict(self, key):
+        # called by spectrum_memory, possibly in a worker thread: the array
+        # stays readable until it is spilled
+        with self._lock:
+            value = self._arrays.get(key)
+            if value is None:   # already dropped
+                return
+            if key == 'y' and self._source is not None:
+                try:
+                    if self._stat_source() == self._source:
+                        del self._arrays[key]
+                        return  # will be read again from the file
+                except OSError:
+                    pass
+            spill = spectrum_memory.spill_path()
+            np.save(spill, value)
+            self._spilled[key] = spill
+            del self._arrays[key]
+
+    def __getstate__(self):
+        # arrays travel with the item (worker processes, copies)
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_arrays'] = {k: self._get_array(k) for k in self.ARRAYS 
+                            if k in self._arrays or k in self._spilled}
+        state['_spilled'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+        if self._x is not None:
+            self._x = intern_axis(self._x)
+        for key, value in self._arrays.items():
+            spectrum_memory.add(self, key, value.nbytes)
+
+
+def load_spectrum(path, lazy=False):
+    ''' Parse and normalize a spectrum file (also run in worker processes),
+    with lazy on first access to its data only '''
+    item = MySpectrumItem(os.path.basename(path), path)
+    item.load_data(lazy)
+    item.current_smoothing = 1
+    return item
+
+
+def convex_hull_bg(x, y):
+    ''' Background under the spectrum from the lower convex hull '''
+    from scipy.spatial import ConvexHull
+
+    v = ConvexHull(np.column_stack((x, y))).vertices
+    v = np.roll(v, -v.argmin())
+    anchors = v[: v.argmax()]
+    return np.interp(x, x[anchors], y[anchors])
+
+
+def window_slice(x, window):
+    ''' Slice of the sorted x axis inside window = (xmin, xmax),
+    all of it if window is None. x[s] and y[s] are views '''
+    if window is None:
+        return slice(None)
+    lo, hi = min(window), max(window)
+    if x[0] <= x[-1]:
+        return slice(np.searchsorted(x, lo, 'left'), np.searchsorted(x, hi, 'right'))
+    n = len(x)     # decreasing axis
+    return slice(n - np.searchsorted(x[::-1], hi, 'right'), 
+                 n - np.searchsorted(x[::-1], lo, 'left'))
+
+
+def auto_fit_window(model, x, y, guess_peak=None, n_widths=8):
+    ''' Window around the peaks found by get_pinit, n_widths peak widths
+    on each side, None for the edge models '''
+    if model.type != "peak":
+        return None
+    p = model.get_pinit(x, y, guess_peak=guess_peak)
+    xbin = abs(x[1] - x[0])
+    lo, hi = np.inf, -np.inf
+    for _, position, *widths in model.peak_index:
+        w = max(sum(abs(p[k]) for k in widths), 3*xbin)
+        lo = min(lo, p[position] - n_widths*w)
+        hi = max(hi, p[position] + n_widths*w)
+    return (max(lo, np.min(x)), min(hi, np.max(x)))
+
+
+def bin_spectrum(x, y, factor):
+    ''' Means of x and y over groups of factor points, the last incomplete
+    group is dropped '''
+    n = len(x) // factor * factor
+    return (x[:n].reshape(-1, factor).mean(axis=1), 
+            y[:n].reshape(-1, factor).mean(axis=1))
+
+
+def fit_spectrum(model, x, y, guess_peak=None, bounded=False, window=None, p0=None, 
+                 use_cache=True, binning=1):
+    ''' Fit the gauge model, returns the fit result and the gauge position.
+    bounded keeps heights and widths positive and positions in the x range
+    (slower trust region fit instead of Levenberg-Marquardt).
+    window = (xmin, xmax) restricts the fit to that range, 'auto' to the
+    peaks found by get_pinit, the window used is returned in the result.
+    p0 replaces the get_pinit initial parameters.
+    binning > 1 first fits the spectrum binned by that factor, and starts
+    the full resolution fit from its result ("nfev" counts both fits,
+    "coarse_nfev" the binned one); when the binned fit fails or its peaks
+    are not finite and inside the window, get_pinit is used instead.
+    Results of peak models are kept in fit_cache, an identical fit returns
+    a copy of the stored result.
+    Raises RuntimeError when the fit does not converge '''
+    from scipy.optimize import curve_fit
+
+    if isinstance(window, str) and window == "auto":
+        window = auto_fit_window(model, x, y, guess_peak=guess_peak)
+    if window is not None:
+        s = window_slice(x, window)
+        x, y = x[s], y[s]
+
+    if model.type == "peak":
+        if len(x) <= len(model.param_names):
+            raise RuntimeError("{} points in the fit window for {} parameters".format(
+                len(x), len(model.param_names)))
+        use_cache = use_cache and fit_cache.enabled
+        if use_cache:
+            key = fit_cache.key(model, x, y, window, guess_peak, p0, bounded, binning)
+            cached = fit_cache.get(key)
+            if cached is not None:
+                return cached
+        coarse_nfev = 0
+        if p0 is None and binning > 1 and len(x) // binning > len(model.param_names):
+            try:
+                coarse, _ = fit_spectrum(model, *bin_spectrum(x, y, binning), 
+                                         guess_peak=guess_peak, bounded=bounded, use_cache=False)
+                # a diverged coarse fit (peak out of the window, inf/nan) is no start
+                positions = coarse["opti"][model.position_index]
+                if (np.all(np.isfinite(coarse["opti"]))
+                        and np.all((positions >= x.min()) & (positions <= x.max()))):
+                    p0 = coarse["opti"]
+                coarse_nfev = coarse["nfev"]
+            except (RuntimeError, ValueError, IndexError):
+                # fit or get_pinit failures on the binned spectrum (e.g. peaks
+                # merged by the binning), fitted at full resolution only;
+                # other errors are bugs and propagate
+                pass
+        if p0 is None:
+            p0 = model.get_pinit(x, y, guess_peak=guess_peak)
+        bounds = (-np.inf, np.inf)
+        if bounded:
+            bounds = model.get_bounds(x)
+            p0 = np.clip(p0, *bounds)
+        popt, pcov, info, _, _ = curve_fit(
+            model.func, x, y, p0=p0, jac=model.jac, bounds=bounds, full_output=True,
+        )
+
+        best_x = model.best_x(popt)
+
+        res = {"opti": popt, "cov": pcov, "window": window, "nfev": coarse_nfev + info["nfev"]}
+        if coarse_nfev:
+            res["coarse_nfev"] = coarse_nfev
+        if use_cache:
+            fit_cache.put(key, res, best_x)
+        return res, best_x
+
+    elif model.type == "edge":
+        grad = np.gradient(y)
+        best_x = x[np.argmin(grad)]
+        return {"opti": best_x, "cov": None, "window": window}, best_x
+
+
+def warm_start_pinit(model, history, extrapolate=3):
+    ''' Initial parameters from the fitted parameters of the previous
+    spectra of a sequence (oldest first): the last fit, with the peak
+    positions extrapolated linearly from the last extrapolate fits '''
+    p0 = np.array(history[-1], dtype=float)
+    n = min(extrapolate, len(history))
+    if n >= 2:
+        positions = np.array([h for h in history[-n:]])[:, model.position_index]
+        slope, intercept = np.polyfit(np.arange(n), positions, 1)
+        p0[model.position_index] = intercept + slope*n
+    for _, _, *widths in model.peak_index:
+        # a width that went to zero (pure lorentzian voigt) is a poor start
+        w = np.abs(p0[widths])
+        p0[widths] = np.maximum(w, 0.05*w.sum())
+    return p0
+
+
+def _mean_square_residual(model, res, x, y):
+    s = window_slice(x, res["window"])
+    return np.mean((model.func(x[s], *res["opti"]) - y[s])**2)
+
+
+def fit_tracking(model, x, y, history, extrapolate=3, window=None, max_residual=None):
+    ''' Fit of one spectrum of a sequence (pressure ramp), started from the
+    previous fits (history of "opti" rows, oldest first, may be empty).
+    Falls back to a cold start from get_pinit if the warm fit fails, leaves
+    the fitted range or has a mean square residual above max_residual.
+    Returns the fit result, with "warm" telling which start was kept,
+    "residual" and "nfev" counting the rejected warm fit, and the gauge position '''
+    rejected_nfev = 0
+    if model.type == "peak" and len(history):
+        try:
+            res, best_x = fit_spectrum(model, x, y, window=window, 
+                                       p0=warm_start_pinit(model, history, extrapolate))
+            rejected_nfev = res["nfev"]
+            s = window_slice(x, res["window"])
+            positions = res["opti"][model.position_index]
+            res["residual"] = _mean_square_residual(model, res, x, y)
+            if (np.all(np.isfinite(res["opti"]))
+                    and np.all((positions >= np.min(x[s])) & (positions <= np.max(x[s])))
+                    and (max_residual is None or res["residual"] <= max_residual)):
+                res["warm"] = True
+                return res, best_x
+        except RuntimeError:
+            pass
+    res, best_x = fit_spectrum(model, x, y, window=window)
+    res["warm"] = False
+    if model.type == "peak":
+        res["nfev"] += rejected_nfev
+        res["residual"] = _mean_square_residual(model, res, x, y)
+    return res, best_x
+
+
+class FitTracker():
+    ''' Tracking fits of a sequence of spectra (pressure ramp), each one
+    started from the previous fitted parameters. fit() fits the next
+    spectrum, or arguments() gives the fit_tracking call to run elsewhere
+    (worker) and add() or skip() record its outcome. A warm fit with a
+    residual residual_factor times the one of the previous spectrum is
+    redone from a cold start. report counts the fitted spectra, their
+    function evaluations, the cold starts and the skipped spectra '''
+    def __init__(self, model, history=None, extrapolate=3, window=None, residual_factor=3):
+        self.model = model
+        self.history = [] if history is None else list(history)
+        self.extrapolate = extrapolate
+        self.window = window
+        self.residual_factor = residual_factor
+        self.max_residual = None
+        self.report = {"spectra": 0, "nfev": 0, "cold_starts": 0, "failed": 0, 
+                       "cold_nfev": None}
+        self._cold_nfev = []    # evaluations of each cold start
+
+    def arguments(self, x, y):
+        return ((self.model, x, y, list(self.history)), 
+                dict(extrapolate=self.extrapolate, window=self.window, 
+                     max_residual=self.max_residual))
+
+    def fit(self, x, y):
+        ''' Fit of the next spectrum, raises RuntimeError (after skip) when
+        it cannot be fitted '''
+        args, kwargs = self.arguments(x, y)
+        try:
+            res, best_x = fit_tracking(*args, **kwargs)
+        except RuntimeError:
+            self.skip()
+            raise
+        self.add(res)
+        return res, best_x
+
+    def add(self, res):
+        self.report["spectra"] += 1
+        if self.model.type == "peak":
+            self.history.append(res["opti"])
+            self.max_residual = self.residual_factor*res["residual"]
+            self.report["nfev"] += res["nfev"]
+            if not res["warm"]:
+                self.report["cold_starts"] += 1
+                self._cold_nfev.append(res["nfev"])
+
+    def skip(self):
+        # the next spectrum starts from the same fits
+        self.report["failed"] += 1
+
+    def cold_nfev_estimate(self):
+        ''' Function evaluations of fitting every spectrum from a cold start:
+        report["cold_nfev"] when measured (fit_sequence with compare), else
+        the mean of the cold starts of the sequence times the number of
+        spectra, None without any cold start '''
+        if self.report["cold_nfev"] is not None:
+            return self.report["cold_nfev"]
+        if not self._cold_nfev:
+            return None
+        return np.mean(self._cold_nfev)*self.report["spectra"]
+
+
+def fit_sequence(model, spectra, history=None, extrapolate=3, window=None, compare=False,
+                 residual_factor=3):
+    ''' Tracking fits of a sequence of (x, y) spectra with a FitTracker.
+    Returns the list of (fit result, gauge position) and the tracker report,
+    with compare report["cold_nfev"] is the evaluations of cold starts of
+    every spectrum. A spectrum that cannot be fitted (RuntimeError) is
+    skipped: (None, None) in the results, counted in report["failed"] '''
+    tracker = FitTracker(model, history, extrapolate, window, residual_factor)
+    if compare:
+        tracker.report["cold_nfev"] = 0
+    results = []
+    for x, y in spectra:
+        try:
+            results.append(tracker.fit(x, y))
+        except RuntimeError:
+            results.append((None, None))
+            continue
+        if compare and model.type == "peak":
+            tracker.report["cold_nfev"] += fit_spectrum(model, x, y, window=window)[0]["nfev"]
+    return results, tracker.report
+
+
+def _levenberg_marquardt(func, jac, x, Y, P, max_iter, ftol, xtol):
+    ''' Levenberg-Marquardt on all the rows of Y at once, func(x, P) and
+    jac(x, P) evaluate the model for each row of P. Each spectrum has its
+    own damping and stops on its own. Returns the parameters, their
+    covariance, the convergence flags and the function evaluations '''
+    n_spectra, n_points = Y.shape
+    n_params = P.shape[1]
+    r = func(x, P) - Y
+    cost = np.einsum('ij,ij->i', r, r)
+    J = jac(x, P)
+    lam = np.full(n_spectra, 1e-1)
+    D = np.zeros((n_spectra, n_params))     # parameter scales, largest curvature seen
+    nfev = np.ones(n_spectra, dtype=int)
+    converged = np.zeros(n_spectra, dtype=bool)
+    active = np.isfinite(cost)
+
+    for _ in range(max_iter):
+        idx = np.flatnonzero(active)
+        if idx.size == 0:
+            break
+        Ja = J[idx]
+        A = np.matmul(Ja.transpose(0, 2, 1), Ja)
+        g = np.matmul(Ja.transpose(0, 2, 1), r[idx, :, None])
+        # Marquardt damping, scaled by the curvature of each parameter
+        D[idx] = np.maximum(D[idx], np.einsum('sii->si', A))
+        M = A + (lam[idx, None] * np.maximum(D[idx], 1e-12))[:, :, None] * np.eye(n_params)
+        try:
+            delta = -np.linalg.solve(M, g)[..., 0]
+        except np.linalg.LinAlgError:
+            delta = -np.matmul(np.linalg.pinv(M), g)[..., 0]
+
+        P_new = P[idx] + delta
+        r_new = func(x, P_new) - Y[idx]
+        cost_new = np.einsum('ij,ij->i', r_new, r_new)
+        nfev[idx] += 1
+
+        accepted = np.isfinite(cost_new) & (cost_new <= cost[idx])
+        small_step = accepted & (np.linalg.norm(delta, axis=1) 
+                                 <= xtol*(xtol + np.linalg.norm(P[idx], axis=1)))
+        small_gain = accepted & (cost[idx] - cost_new <= ftol*cost[idx])
+        stuck = ~accepted & (lam[idx] > 1e16)      # no better point around
+
+        acc = idx[accepted]
+        P[acc] = P_new[accepted]
+        r[acc] = r_new[accepted]
+        cost[acc] = cost_new[accepted]
+        if acc.size:
+            J[acc] = jac(x, P[acc])
+        lam[acc] = np.maximum(lam[acc] / 10, 1e-12)
+        lam[idx[~accepted]] *= 10
+
+        done = idx[small_step | small_gain | stuck]
+        converged[done] = True
+        active[done] = False
+
+    # covariance as in curve_fit, from the jacobian at the solution
+    pcov = np.linalg.pinv(np.matmul(J.transpose(0, 2, 1), J))
+    pcov *= (cost / (n_points - n_params))[:, None, None]
+    return P, pcov, converged, nfev
+
+
+def fit_spectra(model, x, Y, p0=None, window=None, max_iter=200,
+                ftol=1.49012e-08, xtol=1.49012e-08, fallback=True, chunk_size=16):
+    ''' Fit the same peak model to every row of Y (n_spectra, n_points),
+    all sharing the x axis, with a Levenberg-Marquardt run on chunk_size
+    spectra at once (the model func needs batch and batch_jac methods, as
+    the fit_models.PeakSum ones). p0 is one row of initial parameters for
+    all the spectra or one row per spectrum, get_pinit of each spectrum if
+    None. A spectrum for which get_pinit fails is not fitted and reported
+    as not converged, with nan parameters. Spectra that do not converge are
+    refitted by fit_spectrum if fallback is set. Returns the fit result, with "opti" (n_spectra, n_params),
+    "cov", "converged" and "nfev" arrays, and the gauge positions '''
+    x = np.asarray(x, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if window is not None:
+        s = window_slice(x, window)
+        x, Y = x[s], Y[:, s]
+    n_spectra, n_points = Y.shape
+    n_params = len(model.param_names)
+    if n_points <= n_params:
+        raise RuntimeError("{} points in the fit window for {} parameters".format(
+            n_points, n_params))
+
+    started = np.ones(n_spectra, dtype=bool)
+    if p0 is None:
+        P = np.full((n_spectra, n_params), np.nan)
+        for i, y in enumerate(Y):
+            try:
+                P[i] = model.get_pinit(x, y)
+            except RuntimeError:
+                started[i] = False
+    else:
+        P = np.array(np.broadcast_to(np.asarray(p0, dtype=float), (n_spectra, n_params)))
+
+    pcov = np.full((n_spectra, n_params, n_params), np.nan)
+    converged = np.zeros(n_spectra, dtype=bool)
+    nfev = np.zeros(n_spectra, dtype=int)
+    rows = np.flatnonzero(started)
+    # chunks small enough for the jacobians to stay in cache
+    for start in range(0, len(rows), chunk_size):
+        s = rows[start:start + chunk_size]
+        P[s], pcov[s], converged[s], nfev[s] = _levenberg_marquardt(
+            model.func.batch, model.func.batch_jac, x, Y[s], P[s], max_iter, ftol, xtol)
+
+    if fallback:
+        for i in np.flatnonzero(~converged & started):
+            try:
+                res, _ = fit_spectrum(model, x, Y[i])
+            except RuntimeError:
+                continue
+            P[i], pcov[i], converged[i] = res["opti"], res["cov"], True
+
+    best_x = P[:, model.position_index].max(axis=1)
+    return {"opti": P, "cov": pcov, "window": window, 
+            "converged": converged, "nfev": nfev}, best_x
+
+
+def _layout_from_signature(func):
+    ''' Parameter layout of a func(x, c, a1, x1, w1, ..., a2, x2, w2, ...)
+    peak model: 3 parameters per peak (one width) or 4 (two widths) '''
+    params = getfullargspec(func).args[1:]
+    n = len(params) - 1
+    per_peak = 3 if n % 3 == 0 else 4
+    peak_index = [tuple(range(1 + k*per_peak, 1 + (k+1)*per_peak))
+                  for k in range(n // per_peak)]
+    return params, [0], peak_index
+
+
+def invert_monotonic(func, p, x_guess, step, tol=1e-10, max_iter=100):
+    ''' x with func(x) = p for arrays of p, func being monotonic around
+    x_guess: the root is bracketed by steps doubling from step around a
+    first Newton step, then refined by Newton steps kept inside the bracket
+    (bisection otherwise). nan where no bracket is found '''
+    p = np.asarray(p, dtype=float)
+    f = lambda x: func(x) - p
+    x_guess = np.broadcast_to(np.asarray(x_guess, dtype=float), np.broadcast(p, f(x_guess)).shape)
+    h = 1e-6*np.maximum(np.abs(x_guess), 1)
+    derivative = lambda x: (f(x + h) - f(x - h))/(2*h)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        start = x_guess - f(x_guess)/derivative(x_guess)
+    start = np.where(np.isfinite(start), start, x_guess)
+    # the first Newton step is a fair scale of its own error
+    step = np.maximum(step, np.abs(start - x_guess)/4)
+    lo, hi = start - step, start + step
+    f_lo, f_hi = f(lo), f(hi)
+    for _ in range(60):
+        # widen the brackets without a sign change, on both sides
+        open_ = np.sign(f_lo) == np.sign(f_hi)
+        if not np.any(open_):
+            break
+        width = hi - lo
+        lo, hi = np.where(open_, lo - width, lo), np.where(open_, hi + width, hi)
+        f_lo, f_hi = f(lo), f(hi)
+    found = np.sign(f_lo) != np.sign(f_hi)
+
+    x = np.where(found, np.clip(start, np.minimum(lo, hi), np.maximum(lo, hi)), np.nan)
+    for _ in range(max_iter):
+        fx = f(x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = x - fx/derivative(x)
+        # keep the half of the bracket holding the root
+        left = np.sign(fx) == np.sign(f_lo)
+        lo, f_lo = np.where(left, x, lo), np.where(left, fx, f_lo)
+        hi, f_hi = np.where(left, hi, x), np.where(left, f_hi, fx)
+        inside = (newton >= lo) & (newton <= hi)
+        x_new = np.where(inside, newton, (lo + hi)/2)
+        done = ~(np.abs(x_new - x) > tol*np.maximum(np.abs(x), 1))
+        x = x_new
+        if np.all(done):
+            break
+    return x
+
+
+class HPCalibration():
+    ''' A general HP calibration object.
+    func(x, T, x0, T0) gives the pressure, inverse(P, T, x0, T0) if given
+    the position, both for numbers or arrays. Without inverse, positions
+    are interpolated from func over xrange (where it is monotonic) '''
+    MAX_INTERPOLANTS = 64
+    INTERPOLANT_POINTS = 513
+
+    def __init__(self, name, func, Tcor_name, 
+                    xname, xunit, x0default, xstep, color, inverse=None, xrange=None):
+        self.name = name
+        self.func = func
+        self.inverse = inverse
+        self.xrange = xrange
+        self._interpolants = OrderedDict()  # (T, x0, T0) -> interpolant, LRU
+        self.Tcor_name = Tcor_name
+        self.xname = xname
+        self.xunit = xunit
+        self.x0default = x0default
+        self.xstep = xstep  # x step in spinboxes using mousewheel
+        self.color = color  # color printed in calibration combobox
+
+    def __repr__(self):
+        return 'HPCalibration : ' + str( {k: v for k, v in self.__dict__.items() 
+                                          if not k.startswith('_')} )
+
+    def __deepcopy__(self, memo):
+        # calibrations are shared by all the HPData copies, with their interpolants
+        return self
+
+    def P(self, x, T=298, x0=None, T0=298):
+        ''' Pressures of an array of positions in one call, T, x0 (default
+        x0default) and T0 are numbers or arrays broadcast with x '''
+        if x0 is None:
+            x0 = self.x0default
+        P = np.asarray(self.func(np.asarray(x, dtype=float), T, x0, T0), dtype=float)
+        return float(P) if np.ndim(P) == 0 else P
+
+    @property
+    def uses_x0(self):
+        ''' False for absolute scales, whose pressure does not depend on x0 '''
+        x = self.x0default
+        return self.P(x, 298, x) != self.P(x, 298, 1.01*x)
+
+    def invfunc(self, p, *args, **kwargs):
+        ''' Position giving the pressure p, nan where there is none.
+        Without inverse, positions come from inverse_interpolant, or func
+        is inverted numerically around x0default (also for the positions
+        whose interpolated value misses the interpolant error estimate) '''
+        if self.inverse is not None:
+            x = self.inverse(p, *args, **kwargs)
+        elif self.xrange is not None and len(args) == 3 and not kwargs:
+            x = self._interpolate_inverse(p, *args)
+        else:
+            x = invert_monotonic(lambda x: self.func(x, *args, **kwargs), p, 
+                                 self.x0default, self.xstep)
+        return float(x) if np.ndim(x) == 0 else x
+
+    def inverse_interpolant(self, T, x0, T0):
+        ''' Monotonic cubic interpolant of the position against the pressure
+        over xrange, built on first use for each (T, x0, T0). Returns
+        (interpolant, (Pmin, Pmax), error estimate), None if func is not
+        monotonic on xrange. The estimate is twice the largest position
+        error after the Newton step of invfunc at the midpoints between
+        nodes, it is checked on each position by invfunc '''
+        key = (float(T), float(x0), float(T0))
+        if key in self._interpolants:
+            self._interpolants.move_to_end(key)
+            return self._interpolants[key]
+        from scipy.interpolate import PchipInterpolator
+
+        x = np.linspace(*self.xrange, self.INTERPOLANT_POINTS)
+        P = self.P(x, *key)
+        if P[0] > P[-1]:
+            x, P = x[::-1], P[::-1]
+        entry = None
+        if np.all(np.diff(P) > 0):
+            interpolant = PchipInterpolator(P, x)
+            # the interpolation error is largest between the nodes
+            xm = (x[1:] + x[:-1])/2
+            Pm = self.P(xm, *key)
+            error = np.abs(self._polish(interpolant, Pm, key) - xm)
+            entry = (interpolant, (P[0], P[-1]), 2*np.max(error) + 4*np.finfo(float).eps*np.max(np.abs(x)))
+        self._interpolants[key] = entry
+        if len(self._interpolants) > self.MAX_INTERPOLANTS:
+            self._interpolants.popitem(last=False)
+        return entry
+
+    def _polish(self, interpolant, P, key):
+        # one Newton step, with the interpolant slope dx/dP
+        x = interpolant(P)
+        return x - (self.P(x, *key) - P)*interpolant(P, 1)
+
+    def _checked_polish(self, entry, P, key):
+        # nan where the residual left after the Newton step shows a position
+        # error above the estimate of the interpolant
+        interpolant, _, estimate = entry
+        x = self._polish(interpolant, P, key)
+        error = np.abs((self.P(x, *key) - P)*interpolant(P, 1))
+        return np.where(error <= estimate, x, np.nan)
+
+    def _interpolate_inverse(self, p, T, x0, T0):
+        if np.ndim(T) == np.ndim(x0) == np.ndim(T0) == 0:
+            # usual case, a single interpolant
+            entry = self.inverse_interpolant(T, x0, T0)
+            if entry is not None:
+                interpolant, (Pmin, Pmax), _ = entry
+                if np.all((p >= Pmin) & (p <= Pmax)):
+                    x = self._checked_polish(entry, np.asarray(p, dtype=float), (T, x0, T0))
+                    if np.all(np.isfinite(x)):
+                        return x
+
+        p, T, x0, T0 = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (p, T, x0, T0)))
+        x = np.full(p.shape, np.nan)
+        keys = np.stack((T.ravel(), x0.ravel(), T0.ravel()), axis=1)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        if len(unique) <= self.MAX_INTERPOLANTS:
+            for i, key in enumerate(unique):
+                entry = self.inverse_interpolant(*key)
+                if entry is None:
+                    continue
+                interpolant, (Pmin, Pmax), _ = entry
+                rows = (inverse.reshape(p.shape) == i) & (p >= Pmin) & (p <= Pmax)
+                x[rows] = self._checked_polish(entry, p[rows], tuple(key))
+        todo = np.isnan(x)
+        if np.any(todo):
+            # outside of xrange, too many different arguments or missed estimate
+            x[todo] = invert_monotonic(lambda v: self.func(v, T[todo], x0[todo], T0[todo]), 
+                                       p[todo], self.x0default, self.xstep)
+        return x
+
+
+class GaugeFitModel():
+    ''' A general pressure gauge fitting model object
+
+    Peak models know their parameter layout: param_names, baseline_index
+    (constant first, then slope if any) and peak_index, one tuple
+    (height, position, width_1, ...) of parameter indices per peak.
+    The layout is read from the func signature if not given
+    (c, a1, x1, w1, ..., a2, x2, w2, ...) '''
+    def __init__(self, name, func,type, color, jac=None,
+                 param_names=None, baseline_index=None, peak_index=None):
+        self.name = name
+        self.func = func
+        self.jac = jac      # analytical jacobian of func, used by the fits if given
+        self.type = type
+        self.color = color  # color printed in calibration combobox
+
+        if type == 'peak' and peak_index is None:
+            param_names, baseline_index, peak_index = _layout_from_signature(func)
+        self.param_names = list(param_names or [])
+        self.baseline_index = list(baseline_index or [])
+        self.peak_index = [tuple(p) for p in peak_index or []]
+        self.position_index = [p[1] for p in self.peak_index]
+
+    @property
+    def n_peaks(self):
+        return len(self.peak_index)
+
+    def get_pinit(self, x, y, guess_peak=None):
+        from scipy.signal import find_peaks
+
+        pinit = np.zeros(len(self.param_names))
+        if self.baseline_index:
+            pinit[self.baseline_index[0]] = y[0]
+
+        xbin = x[1] - x[0] # nm/px or cm-1/px
+        if guess_peak is None:
+            pk, prop = find_peaks(y - np.min(y), height = np.ptp(y)/2, width=0.1/xbin)
+            if len(pk) < len(self.peak_index):
+                raise RuntimeError('found {} peaks for a {}-peak model'.format(
+                    len(pk), len(self.peak_index)))
+            # the highest maxima, positions and widths taken in the same order
+            order = np.argsort(prop['peak_heights'])[::-1][:len(self.peak_index)]
+            for (height, position, *widths), k in zip(self.peak_index, order):
+                pinit[height] = 0.5
+                pinit[position] = x[pk[k]]
+                for w in widths:    # peak width shared between the width parameters
+                    pinit[w] = prop['widths'][k] * xbin / len(widths)
+        else:
+            for i, (height, position, *widths) in enumerate(self.peak_index):
+                pinit[height] = 0.5
+                pinit[position] = guess_peak - 1.5*i    # idiot trick for the 2nd peak
+                for w in widths:
+                    pinit[w] = 0.5 if len(widths) == 1 else 0.2
+        return list(pinit)
+
+    def get_bounds(self, x):
+        ''' (lower, upper) bounds for curve_fit: positive heights and widths,
+        positions inside the x range, free baseline '''
+        lower = np.full(len(self.param_names), -np.inf)
+        upper = np.full(len(self.param_names), np.inf)
+        for height, position, *widths in self.peak_index:
+            lower[[height] + widths] = 0
+            lower[position], upper[position] = np.min(x), np.max(x)
+        return lower, upper
+
+    def best_x(self, popt):
+        ''' Gauge position from the fitted parameters, the highest peak
+        position (R1 line for ruby) '''
+        return np.max(np.asarray(popt)[self.position_index])
+
+    def __repr__(self):
+        return 'GaugeFitModel : ' + str( self.__dict__ )
+    
+
+
+class HPData():
+
+    def __init__(self, Pm, P, x, T, x0, T0, calib, file):
+        super().__init__()
+
+        self.Pm = Pm
+        self.P = P
+        self.x = x
+        self.T = T
+        self.x0 = x0
+        self.T0 = T0
+        self.calib = calib
+        self.file = file
+
+    def __repr__(self):
+        return str(self.df)
+
+    def calcP(self):
+        self.P = self.calib.func(self.x, self.T, self.x0, self.T0)
+
+    def invcalcP(self):
+        self.x = self.calib.invfunc(self.P, self.T, self.x0, self.T0)
+
+    # SOMETHING TO RETRIEVE THE CALIB OBJECT BY ITS NAME ?
+
+    @property
+    def df(self):       
+        import pandas as pd
+        _df = pd.DataFrame({'Pm': self.Pm,
+                            'P' : self.P, 
+                            'x' : self.x,
+                            'T' : self.T,
+                            'x0': self.x0,
+                            'T0': self.T0,
+                            'calib': self.calib.name,
+                            'file' : self.file}, index=[0])
+        return _df
+
+
+class HPDataList():
+    ''' List of HPData, notify() is called after each change '''
+
+    def __init__(self, df=None, calibrations=None):
+        self.datalist = []
+
+        if df is not None:
+            self.reconstruct_from_df(df, calibrations)
+
+    def __repr__(self):
+        return str( self.df )
+
+    def __getitem__(self, index):
+        return self.datalist[index]
+
+    def __setitem__(self, index, HPDataobj):
+        self.datalist[index] = HPDataobj
+        self.notify()
+
+    def __len__(self):
+        return len(self.datalist)
+
+    def notify(self):
+        pass
+
+
+    def recalc_item_P(self, index):
+        # method implemented to emit change!
+        self.datalist[index].calcP()
+        self.notify()
+
+    def reinvcalc_item_P(self, index):
+        self.datalist[index].invcalcP()
+        self.notify()
+
+    def column(self, attr, rows=None):
+        ''' Values of one HPData attribute as an array, for rows (indices) or all '''
+        rows = range(len(self.datalist)) if rows is None else rows
+        return np.array([getattr(self.datalist[i], attr) for i in rows], dtype=float)
+
+    def recalc(self, rows=None, keep='x'):
+        ''' Pressures of rows (all by default) from their positions, or
+        positions from their pressures with keep='P', computed with one
+        call per calibration, notify() once '''
+        rows = list(range(len(self.datalist))) if rows is None else list(rows)
+        groups = {}
+        for i in rows:
+            groups.setdefault(id(self.datalist[i].calib), []).append(i)
+        for group in groups.values():
+            calib = self.datalist[group[0]].calib
+            T, x0, T0 = (self.column(a, group) for a in ('T', 'x0', 'T0'))
+            if keep == 'x':
+                values, attr = calib.P(self.column('x', group), T, x0, T0), 'P'
+            else:
+                values, attr = calib.invfunc(self.column('P', group), T, x0, T0), 'x'
+            for i, v in zip(group, np.atleast_1d(values).tolist()):
+                setattr(self.datalist[i], attr, v)
+        self.notify()
+
+    def set_reference(self, rows=None, keep='x', **values):
+        ''' Set x0, T0, T or calib (keyword arguments) of rows (all by
+        default) and recompute them as recalc does, with one notify() '''
+        unknown = set(values) - {'x0', 'T0', 'T', 'calib'}
+        if unknown:
+            raise TypeError('cannot set {}'.format(', '.join(sorted(unknown))))
+        rows = list(range(len(self.datalist))) if rows is None else list(rows)
+        for i in rows:
+            for attr, v in values.items():
+                setattr(self.datalist[i], attr, v)
+        self.recalc(rows, keep)
+
+    def pressure_matrix(self, calibrations, rows=None, x0_tol=0.01):
+        ''' Pressures of rows (all by default) with each of calibrations, as a
+        (n_rows, n_calibrations) array computed with one call per calibration.
+        A row is evaluated with its own x, T, x0 and T0, by its own
+        calibration and by the other calibrations of the same xname and
+        xunit whose x0default is within x0_tol (relative) of its x0, so that
+        a ruby row is not read with the samarium scale nor a diamond row with
+        the cBN one. Calibrations ignoring x0 test instead that x is within
+        their xrange, if they have one; nan elsewhere '''
+        rows = list(range(len(self.datalist))) if rows is None else list(rows)
+        x, T, x0, T0 = (self.column(a, rows) for a in ('x', 'T', 'x0', 'T0'))
+        kinds = np.array([(self.datalist[i].calib.xname, self.datalist[i].calib.xunit)
+                          for i in rows], dtype=object).reshape(len(rows), 2)
+        names = np.array([self.datalist[i].calib.name for i in rows], dtype=object)
+        matrix = np.full((len(rows), len(calibrations)), np.nan)
+        for j, calib in enumerate(calibrations):
+            mask = (kinds[:, 0] == calib.xname) & (kinds[:, 1] == calib.xunit)
+            if x0_tol is not None and calib.xrange is not None and not calib.uses_x0:
+                mask &= (x >= min(calib.xrange)) & (x <= max(calib.xrange))
+            elif x0_tol is not None:
+                mask &= np.abs(x0 - calib.x0default) <= x0_tol * calib.x0default
+            mask |= names == calib.name
+            if mask.any():
+                matrix[mask, j] = calib.P(x[mask], T[mask], x0[mask], T0[mask])
+        return matrix
+
+    def setitemval(self, item, attr, val):
+        if val != getattr(self.datalist[item],attr): 
+            setattr(self.datalist[item], attr, val)
+            self.notify()
+
+    def add(self, buffer):
+        # NB:  deepcopy fails if HPData inherits from QObject !
+        # deepcopy absolutely necessary here
+        # Here I work with the HPData object
+        self.datalist.append( deepcopy(buffer) )
+        self.notify()
+
+    def removelast(self):
+        # Here I work with the HPData object
+        self.datalist = self.datalist[:-1]
+        self.notify()
+
+    def removespecific(self, index):
+        del self.datalist[index]
+        self.notify()
+
+    def reset(self, datalist):
+        # erases the previous content!
+        self.datalist = list(datalist)
+        self.notify()
+
+    def reconstruct_from_df(self, df, calibrations):
+        # erases the previous content!
+        self.datalist = []
+        for _, row in df.iterrows():
+            HPdi = HPData(Pm = row['Pm'],
+                          P  = row['P'], 
+                          x  = row['x'], 
+                          T  = row['T'], 
+                          x0 = row['x0'], 
+                          T0 = row['T0'],
+                          calib = calibrations[row['calib']], # retrieve calib
+                          file = row['file'])
+            self.datalist.append(HPdi)
+        self.notify()
+
+    @property
+    def df(self):
+        # should be used only as a REPRESENTATION of HPDataTable
+        import pandas as pd
+        columns = ['Pm','P','x','T','x0','T0','calib','file']
+        return pd.DataFrame({'Pm': [d.Pm for d in self.datalist],
+                             'P' : [d.P for d in self.datalist],
+                             'x' : [d.x for d in self.datalist],
+                             'T' : [d.T for d in self.datalist],
+                             'x0': [d.x0 for d in self.datalist],
+                             'T0': [d.T0 for d in self.datalist],
+                             'calib': [d.calib.name for d in self.datalist],
+                             'file' : [d.file for d in self.datalist]}, columns=columns)
+
+
+#####################################################################################
+# Session files: a .npz holding one contiguous array per kind of data and 
+# a JSON manifest (stored as bytes) describing where each item's arrays are
+
+SESSION_FORMAT = 'myPGM session'
+SESSION_VERSION = 2
+HPDATA_FIELDS = ('Pm', 'P', 'x', 'T', 'x0', 'T0')
+SESSION_ARRAYS = ('x', 'y', 'corrected_y', 'bg', 'opti', 'cov')
+
+
+def _pack(arrays):
+    # ragged arrays -> one flat array and (offset, shape) slots, None is kept as None
+    chunks, slots, pos = [], [], 0
+    for a in arrays:
+        if a is None:
+            slots.append(None)
+            continue
+        a = np.asarray(a, dtype=np.float64)
+        slots.append([pos, list(a.shape)])
+        chunks.append(a.ravel())
+        pos += a.size
+    packed = np.concatenate(chunks) if chunks else np.empty(0)
+    return packed, slots
+
+
+def _unpack(packed, slot):
+    if slot is None:
+        return None
+    start, shape = slot
+    if not shape:   # scalar, e.g. the edge position
+        return packed[start]
+    return packed[start:start + int(np.prod(shape))].reshape(shape)
+
+
+def _hpdata_to_dict(point):
+    d = {k: float(getattr(point, k)) for k in HPDATA_FIELDS}
+    d['calib'] = point.calib.name
+    d['file'] = point.file
+    return d
+
+
+def save_session(f, items, datalist):
+    ''' Save spectrum items and HPData table rows to a .npz session file '''
+    arrays = {}
+    # shared x axes are written once
+    axes, axis_index = {}, []
+    for item in items:
+        x = item.x
+        if x is not None:
+            axes.setdefault(id(x), (len(axes), x))
+        axis_index.append(None if x is None else axes[id(x)][0])
+    sources = {
+        'x': [x for _, x in axes.values()],
+        'y': [item.y for item in items],
+        'corrected_y': [item.corrected_y for item in items],
+        'bg': [item.bg for item in items],
+        'opti': [None if item.fit_result is None else item.fit_result['opti'] 
+                 for item in items],
+        'cov': [None if item.fit_result is None else item.fit_result['cov'] 
+                for item in items],
+    }
+    slots = {}
+    for k in SESSION_ARRAYS:
+        arrays[k], slots[k] = _pack(sources[k])
+
+    manifest_items = []
+    for i, item in enumerate(items):
+        manifest_items.append({
+            'name': item.name,
+            'path': item.path,
+            'current_smoothing': item.current_smoothing,
+            'fit_model': None if item.fit_model is None else item.fit_model.name,
+            'fitted': item.fit_result is not None,
+            'fit_window': item.fit_window,
+            'fit_toolbox_config': None if item.fit_toolbox_config is None 
+                                  else _hpdata_to_dict(item.fit_toolbox_config),
+            'arrays': {k: slots[k][i] for k in SESSION_ARRAYS if k != 'x'},
+            'axis': axis_index[i],
+        })
+
+    arrays['table'] = np.array([[getattr(point, k) for k in HPDATA_FIELDS] 
+                                for point in datalist], 
+                               dtype=np.float64).reshape(-1, len(HPDATA_FIELDS))
+    manifest = {'format': SESSION_FORMAT,
+                'version': SESSION_VERSION,
+                'axes': slots['x'],
+                'items': manifest_items,
+                'table': {'calib': [point.calib.name for point in datalist],
+                          'file': [point.file for point in datalist]}}
+    arrays['manifest'] = np.frombuffer(json.dumps(manifest).encode(), dtype=np.uint8)
+
+    with open(f, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def load_session(f, models, calibrations):
+    ''' Load a session file, models and calibrations are dicts by name.
+    Returns the list of spectrum items and the list of HPData table rows '''
+    with np.load(f, allow_pickle=False) as npz:
+        manifest = json.loads(npz['manifest'].tobytes().decode())
+        if manifest.get('format') != SESSION_FORMAT:
+            raise ValueError('{} is not a myPGM session file'.format(f))
+        if manifest.get('version') != SESSION_VERSION:
+            raise ValueError('{}: unsupported session version {}'.format(
+                f, manifest.get('version')))
+        # one read per kind of data
+        arrays = {k: npz[k] for k in SESSION_ARRAYS + ('table',)}
+
+    axes = [intern_axis(_unpack(arrays['x'], slot)) 
+            for slot in manifest['axes']]
+    items = []
+    for m in manifest['items']:
+        item = MySpectrumItem(m['name'], m['path'])
+        item.current_smoothing = m['current_smoothing']
+        if m['axis'] is not None:
+            item.x = axes[m['axis']]
+        for key in MySpectrumItem.ARRAYS:
+            # own copies, evicting a view of the session arrays would free nothing
+            value = _unpack(arrays[key], m['arrays'][key])
+            setattr(item, key, None if value is None else value.copy())
+        item.fit_model = models.get(m['fit_model'])
+        if m.get('fit_window') is not None:
+            item.fit_window = tuple(m['fit_window'])
+        if m['fitted']:
+            item.fit_result = {'opti': _unpack(arrays['opti'], m['arrays']['opti']),
+                               'cov': _unpack(arrays['cov'], m['arrays']['cov']),
+                               'window': item.fit_window}
+        if m['fit_toolbox_config'] is not None:
+            config = dict(m['fit_toolbox_config'])
+            config['calib'] = calibrations[config['calib']]
+            item.fit_toolbox_config = HPData(**config)
+        items.append(item)
+
+    datalist = []
+    table = manifest['table']
+    for values, calib, file in zip(arrays['table'], table['calib'], table['file']):
+        datalist.append(HPData(**dict(zip(HPDATA_FIELDS, values.tolist())), 
+                               calib=calibrations[calib], file=file))
+    return items, datalist
+
+
+if __name__ == '__main__':
+    import glob
+    from timeit import timeit
+
+    def reference_parse(f):
+        # previous line by line parser, kept here for comparison
+        with open(f, 'r') as file:
+            for _ in range(100):
+                file.readline()
+            chunk = file.read(2000)
+            file.seek(0)
+            delimiter = csv.Sniffer().sniff(chunk).delimiter
+            data_lines = []
+            for line in file:
+                sp = line.strip().split(delimiter)
+                if len(sp) >= 2:
+                    try:
+                        _ = list(map(float, sp))
+                        data_lines.append(line)
+                    except ValueError:
+                        pass
+            data = np.array([line.strip().split(delimiter) for line in data_lines], 
+                dtype=np.float64)
+            return data[:, :2]
+
+    for f in sorted(glob.glob(os.path.dirname(__file__)+'/resources/Example_*')):
+        new = parse_file2data(f)
+        assert np.array_equal(new, reference_parse(f))
+        t_new = timeit(lambda: parse_file2data(f), number=50) / 50
+        t_ref = timeit(lambda: reference_parse(f), number=50) / 50
+        customparse_file2data(f)
+        t_cache = timeit(lambda: customparse_file2data(f), number=50) / 50
+        print('{:<35} {:>5} rows  line by line: {:6.2f} ms  block: {:6.2f} ms  speedup: x{:.1f}  cached: {:6.2f} ms'.format(
+            os.path.basename(f), len(new), 1e3*t_ref, 1e3*t_new, t_ref/t_new, 1e3*t_cache))
@@ -1,7 +1,7 @@
 import numpy as np
-from scipy.special import voigt_profile as voigt
+from scipy.special import voigt_profile as voigt, wofz
 
-import helpers
+import core
 
 def Single_Gaussian(x, c, a1, x1, sigma1):
     return c + a1*np.exp(-(x-x1)**2/(2*sigma1**2))
@@ -25,37 +25,324 @@ def Double_Lorentzian(x, c, a1, x1, gamma1, a2, x2, gamma2):
            Single_Lorentzian(x, 0, a2, x2, gamma2)    
 
 
-DoubleVoigt = helpers.GaugeFitModel(name = 'Double Voigt',
-                                 func = Double_Voigt,
-                                 type = 'peak',
-                                 color = 'firebrick')
-
-DoubleGaussian = helpers.GaugeFitModel(name = 'Double Gaussian',
-                                 func = Double_Gaussian,
-                                 type = 'peak',
-                                 color = 'firebrick')
-
-DoubleLorentzian = helpers.GaugeFitModel(name = 'Double Lorentzian',
-                                 func = Double_Lorentzian,
-                                 type = 'peak',
-                                 color = 'firebrick')
-
-SingleLorentzian = helpers.GaugeFitModel(name = 'Single Lorentzian',
-                                 func = Single_Lorentzian,
-                                 type = 'peak',
-                                 color = 'mediumseagreen')
-
-SingleVoigt= helpers.GaugeFitModel(name = 'Single Voigt',
-                                    func = Single_Voigt,
-                                    type = 'peak',
-                                    color = 'mediumseagreen')
-                
-SingleGaussian = helpers.GaugeFitModel(name = 'Single Gaussian',
-                                    func = Single_Gaussian,
-                                    type = 'peak',
-                                    color = 'mediumseagreen')
-
-RamanEdge = helpers.GaugeFitModel(name = 'Raman Edge',
+
+# Analytical derivatives of a peak with respect to (a, x0, widths...)
+
+def _gaussian_peak_jac(x, a, x0, sigma):
+    u = x - x0
+    e = np.exp(-u**2/(2*sigma**2))
+    return [e, a*e*u/sigma**2, a*e*u**2/sigma**3]
+
+def _lorentzian_peak_jac(x, a, x0, gamma):
+    u = x - x0
+    D = 1 + 4*u**2/gamma**2
+    return [(2/(np.pi*gamma)) / D,
+            a * 16*u / (np.pi * gamma**3 * D**2),
+            -a * (2/np.pi) * (1 - 4*u**2/gamma**2) / (gamma*D)**2]
+
+def _wofz(z, derivative=False):
+    w = wofz(z)
+    if not derivative:
+        return w
+    dw = -2*z*w + 2j/np.sqrt(np.pi)
+    # the relation cancels far from the peak (narrow gaussian part),
+    # asymptotic series w' = i/sqrt(pi) sum -(2n+1) (2n-1)!!/2^n / z^(2n+2) there
+    far = (np.abs(z) > 15) & (z.imag >= 0)
+    if far.any():
+        u = 1 / z[far]**2
+        s, c = 0, 1
+        for n in range(9):
+            s = s - (2*n + 1)*c*u**n
+            c *= (2*n + 1)/2
+        dw[far] = 1j/np.sqrt(np.pi) * s * u
+    return w, dw
+
+def _voigt_peak_jac(x, a, x0, sigma, gamma, faddeeva=_wofz):
+    # V = Re[w(z)] / (sigma sqrt(2 pi)), z = (x - x0 + i gamma) / (sigma sqrt(2))
+    # with w'(z) = -2 z w(z) + 2i / sqrt(pi)
+    z = (x - x0 + 1j*gamma) / (sigma*np.sqrt(2))
+    w, dw = faddeeva(z, derivative=True)
+    V = w.real / (sigma*np.sqrt(2*np.pi))
+    k = 1 / (2*sigma**2*np.sqrt(np.pi))     # dV/dz = k * sigma sqrt(2) * w'
+    return [V,
+            -a * k * dw.real,
+            -a * (V + (z*dw).real / (sigma*np.sqrt(2*np.pi))) / sigma,
+            -a * k * dw.imag]
+
+def _gaussian_peak(x, a, x0, sigma):
+    return a*np.exp(-(x-x0)**2/(2*sigma**2))
+
+def _lorentzian_peak(x, a, x0, gamma):
+    return a * (2/(np.pi*gamma)) / (1 + ((x - x0)/(gamma/2))**2)
+
+def _voigt_peak(x, a, x0, sigma, gamma):
+    return a * voigt(x-x0, sigma, gamma)
+
+
+# Faster approximations of the Voigt profile, same sigma and gamma as
+# voigt_profile (gaussian standard deviation, lorentzian half width).
+# Both are even in sigma and gamma.
+#
+# Thompson-Cox-Hastings pseudo-Voigt (J. Appl. Cryst. 20, 79 (1987)):
+# eta L + (1 - eta) G with L and G of the same total width f.
+# Deviation from voigt_profile < 1.3 % of the peak height for any
+# gamma/sigma, evaluation about 3 times faster on 2048 points.
+#
+# Humlicek W4 rational approximation of the Faddeeva function
+# (J. Quant. Spectrosc. Radiat. Transfer 27, 437 (1982)):
+# deviation < 4e-5 of the peak height, evaluation about 1.5 times faster.
+#
+# Run this file for the accuracy check and the timings.
+
+_FWHM = 2*np.sqrt(2*np.log(2))    # gaussian FWHM / sigma
+
+def _tch_mix(sigma, gamma):
+    fG = _FWHM*np.abs(sigma)
+    fL = 2*np.abs(gamma)
+    P = (fG**5 + 2.69269*fG**4*fL + 2.42843*fG**3*fL**2 + 4.47163*fG**2*fL**3
+         + 0.07842*fG*fL**4 + fL**5)
+    f = P**0.2
+    r = fL/f
+    eta = 1.36603*r - 0.47719*r**2 + 0.11116*r**3
+    return fG, fL, P, f, r, eta
+
+def _tch_LG(u2, f):
+    hw = f/2
+    D = u2 + hw**2
+    L = hw / (np.pi*D)
+    s = f/_FWHM
+    G = np.exp(-u2/(2*s**2)) / (s*np.sqrt(2*np.pi))
+    return hw, D, L, s, G
+
+def _pseudo_voigt_peak(x, a, x0, sigma, gamma):
+    _, _, _, f, _, eta = _tch_mix(sigma, gamma)
+    _, _, L, _, G = _tch_LG((x - x0)**2, f)
+    return a*(eta*L + (1 - eta)*G)
+
+def _pseudo_voigt_peak_jac(x, a, x0, sigma, gamma):
+    fG, fL, P, f, r, eta = _tch_mix(sigma, gamma)
+    u = x - x0
+    u2 = u**2
+    hw, D, L, s, G = _tch_LG(u2, f)
+    # total width and mixing derivatives
+    dP_dfG = (5*fG**4 + 4*2.69269*fG**3*fL + 3*2.42843*fG**2*fL**2
+              + 2*4.47163*fG*fL**3 + 0.07842*fL**4)
+    dP_dfL = (2.69269*fG**4 + 2*2.42843*fG**3*fL + 3*4.47163*fG**2*fL**2
+              + 4*0.07842*fG*fL**3 + 5*fL**4)
+    df_dsigma = 0.2*f/P * dP_dfG * _FWHM*np.sign(sigma)
+    df_dgamma = 0.2*f/P * dP_dfL * 2*np.sign(gamma)
+    deta_dr = 1.36603 - 2*0.47719*r + 3*0.11116*r**2
+    deta_dsigma = deta_dr * (-r/f * df_dsigma)
+    deta_dgamma = deta_dr * (2*np.sign(gamma)/f - r/f * df_dgamma)
+    # profile derivatives at fixed f and eta
+    dL_du = -2*u*hw / (np.pi*D**2)
+    dG_du = -u/s**2 * G
+    dL_df = 1/(2*np.pi*D) - hw**2/(np.pi*D**2)
+    dG_df = G*(u2/s**3 - 1/s) / _FWHM
+    V = eta*L + (1 - eta)*G
+    dV_df = eta*dL_df + (1 - eta)*dG_df
+    return [V,
+            -a*(eta*dL_du + (1 - eta)*dG_du),
+            a*(dV_df*df_dsigma + (L - G)*deta_dsigma),
+            a*(dV_df*df_dgamma + (L - G)*deta_dgamma)]
+
+# W4 regions as rational functions of t = -iz, t Pu(t^2) / Qu(t^2) except
+# region 2 which is P(t) / Q(t) (highest degree first); region 3 is
+# exp(t^2) - t Pu(t^2) / Qu(t^2)
+_HUMLICEK = [([0.5641896], [1, 0.5]),
+             ([0.5641896, 1.410474], [1, 3, 0.75]),
+             ([0.5642236, 3.778987, 11.96482, 20.20933, 16.4955],
+              [1, 6.699398, 21.69274, 39.27121, 38.82363, 16.4955]),
+             ([0.56419, -1.320522, 35.76683, -219.0313, 1540.787, -3321.9905, 36183.31],
+              [-1, 1.841439, -61.57037, 364.2191, -2186.181, 9022.228, -24322.84, 32066.6])]
+
+def _humlicek_w(z, derivative=False):
+    ''' Faddeeva function w(z) for Im(z) >= 0, Humlicek W4, and its
+    derivative dw/dz if asked (of the approximation itself, the exact
+    relation w' = -2zw + 2i/sqrt(pi) loses all digits far from the peak) '''
+    t = z.imag - 1j*z.real
+    s = np.abs(z.real) + z.imag
+    region = np.where(s >= 15, 0, np.where(s >= 5.5, 1, np.where(
+        z.imag >= 0.195*np.abs(z.real) - 0.176, 2, 3)))
+    w = np.empty(z.shape, dtype=complex)
+    dw = np.empty(z.shape, dtype=complex) if derivative else None
+    for k, (P, Q) in enumerate(_HUMLICEK):
+        mask = region == k
+        if not mask.any():
+            continue
+        tk = t[mask]
+        if k == 2:
+            p, q = np.polyval(P, tk), np.polyval(Q, tk)
+            if derivative:
+                dp, dq = np.polyval(np.polyder(P), tk), np.polyval(np.polyder(Q), tk)
+        else:
+            u = tk*tk
+            pu = np.polyval(P, u)
+            p, q = tk*pu, np.polyval(Q, u)
+            if derivative:
+                dp = pu + 2*u*np.polyval(np.polyder(P), u)
+                dq = 2*tk*np.polyval(np.polyder(Q), u)
+        w[mask] = p/q
+        if derivative:
+            dwdt = (dp*q - p*dq) / q**2
+        if k == 3:
+            e = np.exp(tk*tk)
+            w[mask] = e - w[mask]
+            if derivative:
+                dwdt = 2*tk*e - dwdt
+        if derivative:
+            dw[mask] = -1j*dwdt     # dt/dz = -i
+    return (w, dw) if derivative else w
+
+def _humlicek_peak(x, a, x0, sigma, gamma):
+    sigma, gamma = np.abs(sigma), np.abs(gamma)
+    z = (x - x0 + 1j*gamma) / (sigma*np.sqrt(2))
+    return a * _humlicek_w(z).real / (sigma*np.sqrt(2*np.pi))
+
+def _humlicek_peak_jac(x, a, x0, sigma, gamma):
+    V, dx0, dsigma, dgamma = _voigt_peak_jac(x, a, x0, np.abs(sigma), np.abs(gamma),
+                                             faddeeva=_humlicek_w)
+    return [V, dx0, dsigma*np.sign(sigma), dgamma*np.sign(gamma)]
+
+
+class LineShape():
+    ''' A peak line shape: profile(x, a, x0, *widths) and the list of its
+    derivatives jac(x, a, x0, *widths), both broadcasting over peaks '''
+    def __init__(self, name, profile, jac, width_names):
+        self.name = name
+        self.profile = profile
+        self.jac = jac
+        self.width_names = width_names
+
+    def __repr__(self):
+        return 'LineShape : ' + self.name
+
+line_shapes = {'gaussian': LineShape('gaussian', _gaussian_peak, _gaussian_peak_jac, ('sigma',)),
+               'lorentzian': LineShape('lorentzian', _lorentzian_peak, _lorentzian_peak_jac, ('gamma',)),
+               'voigt': LineShape('voigt', _voigt_peak, _voigt_peak_jac, ('sigma', 'gamma')),
+               'pseudo-voigt': LineShape('pseudo-voigt', _pseudo_voigt_peak, _pseudo_voigt_peak_jac,
+                                         ('sigma', 'gamma')),
+               'humlicek': LineShape('humlicek', _humlicek_peak, _humlicek_peak_jac, ('sigma', 'gamma')),
+               }
+
+
+class PeakSum():
+    ''' Sum of n_peaks line shapes on a constant or linear baseline,
+    called as func(x, c, [b,] a1, x1, w1, ..., a2, x2, w2, ...) with all
+    peaks evaluated at once. Picklable, the line shape is kept by name '''
+    def __init__(self, shape, n_peaks, baseline='constant'):
+        if shape not in line_shapes:
+            raise ValueError('unknown line shape {!r}, choose from {}'.format(
+                shape, ', '.join(line_shapes)))
+        if baseline not in ('constant', 'linear'):
+            raise ValueError("baseline must be 'constant' or 'linear'")
+        self.shape = shape
+        self.n_peaks = n_peaks
+        self.baseline = baseline
+
+        self.param_names = ['c', 'b'] if baseline == 'linear' else ['c']
+        self.baseline_index = list(range(len(self.param_names)))
+        per_peak = 2 + len(line_shapes[shape].width_names)
+        self.peak_index = []
+        for k in range(1, n_peaks + 1):
+            start = len(self.param_names)
+            self.param_names += [name + str(k) for name in
+                                 ('a', 'x') + line_shapes[shape].width_names]
+            self.peak_index.append(tuple(range(start, start + per_peak)))
+        self._index = np.array(self.peak_index, dtype=int).reshape(n_peaks, per_peak)
+
+    def _peak_params(self, p):
+        p = np.asarray(p, dtype=float)
+        return [p[col] for col in self._index.T]
+
+    def __call__(self, x, *p):
+        x = np.asarray(x, dtype=float)
+        y = line_shapes[self.shape].profile(x[..., None], *self._peak_params(p)).sum(axis=-1)
+        y = y + p[0]
+        if self.baseline == 'linear':
+            y = y + p[1]*x
+        return y
+
+    def jac(self, x, *p):
+        x = np.asarray(x, dtype=float)
+        J = np.empty(x.shape + (len(self.param_names),))
+        J[..., 0] = 1
+        if self.baseline == 'linear':
+            J[..., 1] = x
+        columns = line_shapes[self.shape].jac(x[..., None], *self._peak_params(p))
+        for col, derivative in zip(self._index.T, columns):
+            J[..., col] = derivative
+        return J
+
+    def _batch_peak_params(self, P):
+        P = np.asarray(P, dtype=float)
+        return [P[:, None, col] for col in self._index.T]
+
+    def batch(self, x, P):
+        ''' Model for each row of the (n_spectra, n_params) parameter matrix,
+        as a (n_spectra, n_points) array '''
+        P = np.asarray(P, dtype=float)
+        x = np.asarray(x, dtype=float)
+        y = line_shapes[self.shape].profile(x[None, :, None], 
+                                            *self._batch_peak_params(P)).sum(axis=-1)
+        y += P[:, :1]
+        if self.baseline == 'linear':
+            y += P[:, 1:2]*x
+        return y
+
+    def batch_jac(self, x, P):
+        ''' Jacobians for each row of P, as a (n_spectra, n_points, n_params) array '''
+        P = np.asarray(P, dtype=float)
+        x = np.asarray(x, dtype=float)
+        J = np.empty((len(P), len(x), len(self.param_names)))
+        J[..., 0] = 1
+        if self.baseline == 'linear':
+            J[..., 1] = x
+        columns = line_shapes[self.shape].jac(x[None, :, None], *self._batch_peak_params(P))
+        for col, derivative in zip(self._index.T, columns):
+            J[..., col] = derivative
+        return J
+
+    def __repr__(self):
+        return 'PeakSum({!r}, {}, {!r})'.format(self.shape, self.n_peaks, self.baseline)
+
+
+def make_peak_model(name, shape, n_peaks=1, baseline='constant', color='firebrick'):
+    ''' GaugeFitModel for n_peaks peaks of the given line shape
+    ('gaussian', 'lorentzian', 'voigt', 'pseudo-voigt' or 'humlicek') on a 'constant' or 'linear'
+    baseline, with its analytical jacobian and parameter layout '''
+    func = PeakSum(shape, n_peaks, baseline)
+    return core.GaugeFitModel(name = name,
+                              func = func,
+                              jac = func.jac,
+                              type = 'peak',
+                              color = color,
+                              param_names = func.param_names,
+                              baseline_index = func.baseline_index,
+                              peak_index = func.peak_index)
+
+
+DoubleVoigt = make_peak_model('Double Voigt', 'voigt', 2, color = 'firebrick')
+
+DoubleGaussian = make_peak_model('Double Gaussian', 'gaussian', 2, color = 'firebrick')
+
+DoubleLorentzian = make_peak_model('Double Lorentzian', 'lorentzian', 2, color = 'firebrick')
+
+SingleLorentzian = make_peak_model('Single Lorentzian', 'lorentzian', 1, color = 'mediumseagreen')
+
+SingleVoigt = make_peak_model('Single Voigt', 'voigt', 1, color = 'mediumseagreen')
+
+SingleGaussian = make_peak_model('Single Gaussian', 'gaussian', 1, color = 'mediumseagreen')
+
+DoublePseudoVoigt = make_peak_model('Double pseudo-Voigt', 'pseudo-voigt', 2, color = 'firebrick')
+
+DoubleHumlicek = make_peak_model('Double Voigt (Humlicek)', 'humlicek', 2, color = 'firebrick')
+
+SinglePseudoVoigt = make_peak_model('Single pseudo-Voigt', 'pseudo-voigt', 1, color = 'mediumseagreen')
+
+SingleHumlicek = make_peak_model('Single Voigt (Humlicek)', 'humlicek', 1, color = 'mediumseagreen')
+
+RamanEdge = core.GaugeFitModel(name = 'Raman Edge',
                                     func = None,
                                     type = 'edge',
                                     color = 'darkgrey')        
@@ -66,5 +353,145 @@ model_list = [DoubleVoigt,
               SingleVoigt,
               SingleLorentzian,
               SingleGaussian,
+              DoublePseudoVoigt,
+              DoubleHumlicek,
+              SinglePseudoVoigt,
+              SingleHumlicek,
               RamanEdge
-              ]
\ No newline at end of file
+              ]
+
+
+if __name__ == '__main__':
+    import os
+    from scipy.optimize import curve_fit
+
+    def numerical_jac(func, x, p, h=1e-6):
+        p = np.asarray(p, dtype=float)
+        cols = []
+        for j in range(len(p)):
+            dp = np.zeros_like(p)
+            dp[j] = h
+            cols.append((func(x, *(p + dp)) - func(x, *(p - dp))) / (2*h))
+        return np.column_stack(cols)
+
+    # analytical jacobians against finite differences
+    rng = np.random.default_rng(0)
+    x = np.linspace(690, 700, 500)
+    def random_params(model):
+        p = np.empty(len(model.param_names))
+        p[model.baseline_index] = rng.uniform(-1, 1, len(model.baseline_index)) * [1, 1e-3][:len(model.baseline_index)]
+        for height, position, *widths in model.peak_index:
+            p[height] = rng.uniform(0.2, 2)
+            p[position] = rng.uniform(692, 698)
+            p[widths] = rng.uniform(0.1, 1, len(widths)) * rng.choice([-1, 1])
+        return p
+
+    test_models = model_list + [make_peak_model('Triple Gaussian + slope', 'gaussian', 3, 'linear'),
+                                make_peak_model('Triple Voigt + slope', 'voigt', 3, 'linear')]
+    for model in test_models:
+        if model.jac is None:
+            continue
+        for _ in range(50):
+            p = random_params(model)
+            ana = model.jac(x, *p)
+            num = numerical_jac(model.func, x, p)
+            bad = ~np.isclose(ana, num, rtol=1e-5, atol=1e-6 * np.abs(num).max())
+            # W4 is piecewise, finite differences across a region boundary see its small jumps
+            assert bad.sum() <= (2 if model.func.shape == 'humlicek' else 0), model.name
+        print('{:<25} analytical jacobian matches finite differences'.format(model.name))
+
+    # accuracy of the Voigt approximations against voigt_profile, relative to
+    # the peak height, over gamma/sigma from 1e-3 to 1e3
+    for shape in ['pseudo-voigt', 'humlicek']:
+        worst = 0
+        for ratio in np.logspace(-3, 3, 61):
+            sigma, gamma = 0.3, 0.3*ratio
+            u = np.linspace(-50*(sigma + gamma), 50*(sigma + gamma), 20001)
+            ref = voigt(u, sigma, gamma)
+            approx = line_shapes[shape].profile(u, 1, 0, sigma, gamma)
+            worst = max(worst, np.abs(approx - ref).max() / ref.max())
+        print('{:<13} max deviation from voigt_profile: {:.2e} of the peak height'.format(shape, worst))
+
+    # evaluation time on a 2048 points spectrum
+    import timeit
+    x2048 = np.linspace(685, 705, 2048)
+    for model in [DoubleVoigt, DoublePseudoVoigt, DoubleHumlicek, DoubleLorentzian]:
+        p = [0.1, 1, 694.3, 0.3, 0.2, 0.5, 692.9, 0.3, 0.2][:len(model.param_names)]
+        if model.n_peaks * 3 + 1 == len(model.param_names):
+            p = [0.1, 1, 694.3, 0.4, 0.5, 692.9, 0.4]
+        t_func = min(timeit.repeat(lambda: model.func(x2048, *p), number=200, repeat=5)) / 200
+        t_jac = min(timeit.repeat(lambda: model.jac(x2048, *p), number=200, repeat=5)) / 200
+        print('{:<25} 2048 points: {:6.1f} us per evaluation, {:6.1f} us per jacobian'.format(
+            model.name, t_func*1e6, t_jac*1e6))
+
+    # built models against the hand written functions
+    legacy = {'Double Voigt': Double_Voigt, 'Double Gaussian': Double_Gaussian,
+              'Double Lorentzian': Double_Lorentzian, 'Single Voigt': Single_Voigt,
+              'Single Gaussian': Single_Gaussian, 'Single Lorentzian': Single_Lorentzian}
+    for model in model_list:
+        if model.name in legacy:
+            p = np.abs(random_params(model))
+            assert np.allclose(model.func(x, *p), legacy[model.name](x, *p)), model.name
+    print('built models match the hand written functions')
+
+    # function evaluations with and without jacobian
+    for f in ['Example_Ruby_1.asc', 'Example_Ruby_2.asc', 'Example_Ruby_3.asc']:
+        item = core.load_spectrum(os.path.dirname(__file__) + '/resources/' + f)
+        x, y = item.x, item.y
+        for model in model_list:
+            if model.jac is None:
+                continue
+            p0 = model.get_pinit(x, y)
+            _, _, info_num, _, _ = curve_fit(model.func, x, y, p0=p0, full_output=True)
+            _, _, info_ana, _, _ = curve_fit(model.func, x, y, p0=p0, jac=model.jac, 
+                                             full_output=True)
+            print('{:<20} {:<20} function evaluations: {:4d} (finite differences)  {:4d} + {} jacobians'.format(
+                f, model.name, info_num['nfev'], info_ana['nfev'], info_ana['njev']))
+
+    # stacked fits of a 1200 spectra pressure ramp against one curve_fit per spectrum
+    import time
+    x = core.load_spectrum(os.path.dirname(__file__) + '/resources/Example_Ruby_1.asc').x
+    ramp = np.linspace(694.3, 697.5, 1200)
+    Y = np.array([DoubleVoigt.func(x, 0.02, 0.6, r, 0.25, 0.12, 0.35, r - 1.45, 0.25, 0.12) 
+                  for r in ramp])
+    Y += rng.normal(0, 0.01, Y.shape)
+    for model in [DoubleLorentzian, DoubleGaussian, DoublePseudoVoigt, DoubleVoigt]:
+        t0 = time.perf_counter()
+        res, best_x = core.fit_spectra(model, x, Y)
+        t1 = time.perf_counter()
+        ref = np.array([core.fit_spectrum(model, x, y)[1] for y in Y])
+        t2 = time.perf_counter()
+        print('{:<20} {} spectra: stacked {:.2f} s, curve_fit {:.2f} s, '
+              '{} positions within 1e-4 of curve_fit'.format(
+              model.name, len(Y), t1 - t0, t2 - t1, np.sum(np.abs(best_x - ref) < 1e-4)))
+
+    # tracking fits of the first 200 spectra of the ramp against cold starts
+    for model in [DoubleLorentzian, DoubleGaussian, DoublePseudoVoigt, DoubleVoigt]:
+        _, report = core.fit_sequence(model, [(x, y) for y in Y[:200]], compare=True)
+        print('{:<20} {} spectra: {} function evaluations tracked, {} from cold starts, '
+              '{} cold start(s)'.format(model.name, report['spectra'], report['nfev'],
+                                         report['cold_nfev'], report['cold_starts']))
+
+    # coarse-to-fine fits: model evaluations on binned then full resolution spectra,
+    # counted in points (a binned evaluation costs 1/binning of a full one)
+    for f in ['Example_Ruby_1.asc', 'Example_Ruby_2.asc', 'Example_Ruby_3.asc', 'Example_H2.txt']:
+        item = core.load_spectrum(os.path.dirname(__file__) + '/resources/' + f)
+        x, y = item.x, item.y
+        for model in [DoubleVoigt, DoubleHumlicek, DoublePseudoVoigt, DoubleLorentzian, 
+                      SingleVoigt, SingleLorentzian]:
+            row = []
+            for binning in [1, 4]:
+                try:
+                    t0 = time.perf_counter()
+                    res, best_x = core.fit_spectrum(model, x, y, use_cache=False, 
+                                                    binning=binning)
+                    t = time.perf_counter() - t0
+                except (RuntimeError, IndexError):
+                    row.append('binning {}: failed'.format(binning).ljust(44))
+                    continue
+                coarse = res.get('coarse_nfev', 0)
+                n = len(x[core.window_slice(x, res['window'])])
+                points = coarse*(n // binning) + (res['nfev'] - coarse)*n
+                row.append('binning {}: {:3d}+{:3d} evaluations, {:6d} points, {:5.1f} ms'.format(
+                    binning, coarse, res['nfev'] - coarse, points, t*1e3))
+            print('{:<20} {:<24} {}'.format(f, model.name, ' | '.join(row)))
@@ -1,12 +1,19 @@
 import numpy as np
-import pandas as pd
 from copy import deepcopy
-from scipy.optimize import minimize
 from PyQt5.QtWidgets import QFrame
-from PyQt5.QtCore import Qt, QObject, pyqtSignal, QAbstractListModel, QModelIndex
-from scipy.signal import find_peaks
-from inspect import getfullargspec
-import csv
+from PyQt5.QtCore import (Qt, QObject, pyqtSignal, QAbstractListModel, QModelIndex, QTimer,
+                          QFileSystemWatcher, QThread, pyqtSlot)
+import os
+import time
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+# Qt-free objects, still available from helpers
+from core import (customparse_file2data, parse_file2data, SpectrumCache, spectrum_cache, 
+                  FitCache, fit_cache, SpectrumMemory, spectrum_memory, intern_axis, 
+                  MySpectrumItem, load_spectrum, convex_hull_bg, fit_spectrum, fit_tracking, 
+                  FitTracker, fit_sequence, window_slice, auto_fit_window, HPCalibration, 
+                  GaugeFitModel, HPData, HPDataList, save_session, load_session)
 
 class MyHSeparator(QFrame):
     def __init__(self):
@@ -21,61 +28,377 @@ class MyVSeparator(QFrame):
         self.setFrameShadow(QFrame.Sunken)
 
 
-def customparse_file2data(f):
-    with open(f, 'r') as file:
-        # Skip initial lines to determine the delimiter
-        initial_skip = 100  
-        for _ in range(initial_skip):
-            file.readline()
-
-        # Read a chunk from the middle of the file to determine the delimiter
-        chunk_size = 2000
-        chunk = file.read(chunk_size)
-        file.seek(0)  # Reset file pointer to the beginning
-
-        delimiter = csv.Sniffer().sniff(chunk).delimiter
-
-        count = 0
-        data_lines = []
-        # Process the file line by line to determine header
-        # When it will reach footer, it will be exluded too
-        for line in file:
-            sp = line.strip().split(delimiter)
-            if len(sp) < 2:
-                count += 1
-            else:
-                try:
-                    _ = list(map(float, sp))
-                    data_lines.append(line)
-                except ValueError:
-                    count += 1
-
-        #print('delimiter : {}'.format(delimiter))
-        #print('count : {}'.format(count))
-
-        # Convert data_lines to a numpy array
-        data = np.array([line.strip().split(delimiter) for line in data_lines], 
-            dtype=np.float64)
-
-        #print('length: {}'.format(len(data)))
-        return data[:, :2]
+class _PoolJobs(QObject):
+    ''' Jobs run in a thread pool, or a process pool with processes=True,
+    their futures polled by a QTimer: subclasses emit the finished ones in
+    _collect, give the ones not emitted yet in _pending and clear their
+    jobs in _reset '''
+    progress = pyqtSignal(int, int)     # done, total
+    finished = pyqtSignal()
 
+    def __init__(self, max_workers=None, processes=True, parent=None):
+        super().__init__(parent)
+        self.max_workers = max_workers
+        self.processes = processes
+        self._executor = None
+        self._timer = QTimer(self)
+        self._timer.setInterval(20)
+        self._timer.timeout.connect(self._collect)
 
-class MySpectrumItem:
-    def __init__(self, name, path):
-        self.name = name
-        self.path = path
-        self.data = None
-        self.corrected_data = None
-        self.bg = None
-        self.current_smoothing = None
-        self.fit_result = None
-        self.fit_toolbox_config = None
-        self.fit_model = None
-
-    def normalize_data(self):
-        self.data[:,1] = self.data[:,1]-np.min(self.data[:,1])
-        self.data[:,1]=self.data[:,1]/max(self.data[:,1])
+    @property
+    def executor(self):
+        if self._executor is None:
+            if self.processes:
+                # spawn: forking a running Qt application is not safe
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def is_running(self):
+        return bool(self._pending())
+
+    def _finish(self):
+        self._timer.stop()
+        self._reset()
+        self.finished.emit()
+
+    def cancel(self):
+        # results already emitted are kept, running jobs are ignored
+        for future in self._pending():
+            future.cancel()
+        if self.is_running():
+            self._finish()
+
+    def shutdown(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class SpectrumImporter(_PoolJobs):
+    ''' Load spectrum files in a process pool, items are emitted in file order.
+    Files beyond the free spectrum_memory budget give lazy items, read on
+    first access to their data '''
+    itemLoaded = pyqtSignal(object)     # MySpectrumItem
+    failed = pyqtSignal(str, str)       # path, error message
+
+    def __init__(self, max_workers=None, serial_threshold=4, parent=None):
+        super().__init__(max_workers, processes=True, parent=parent)
+        # below this number of files the pool start-up costs more than it saves
+        self.serial_threshold = serial_threshold
+        self._jobs = []     # (path, future) in file order
+        self._next = 0      # index of the next job to emit
+
+    def _pending(self):
+        return [future for _, future in self._jobs[self._next:]]
+
+    def is_running(self):
+        return self._next < len(self._jobs)
+
+    def start(self, files):
+        lazy = self._lazy_flags(files)
+        if not self.is_running() and len(files) <= self.serial_threshold:
+            for i, path in enumerate(files):
+                self._emit_result(path, load_spectrum, path, lazy[i])
+                self.progress.emit(i + 1, len(files))
+            self.finished.emit()
+            return
+
+        # new files are queued after the ones still loading
+        for path, lazy_item in zip(files, lazy):
+            if lazy_item:
+                future = Future()
+                future.set_result(load_spectrum(path, lazy=True))
+            else:
+                future = self.executor.submit(load_spectrum, path)
+            self._jobs.append((path, future))
+        self.progress.emit(self._next, len(self._jobs))
+        self._timer.start()
+
+    @staticmethod
+    def _lazy_flags(files):
+        # the file sizes are an upper bound of the arrays they give
+        free = spectrum_memory.budget - spectrum_memory.size
+        flags = []
+        for path in files:
+            flags.append(free <= 0)
+            try:
+                free -= os.path.getsize(path)
+            except OSError:
+                pass
+        return flags
+
+    def _emit_result(self, path, func, *args):
+        try:
+            item = func(*args)
+        except Exception as e:
+            self.failed.emit(path, str(e))
+        else:
+            self.itemLoaded.emit(item)
+
+    def _collect(self):
+        # only emit the finished futures that keep the file order
+        while self.is_running() and self._jobs[self._next][1].done():
+            path, future = self._jobs[self._next]
+            self._next += 1
+            self._emit_result(path, future.result)
+            self.progress.emit(self._next, len(self._jobs))
+        if not self.is_running():
+            self._finish()
+
+    def _reset(self):
+        self._jobs = []
+        self._next = 0
+
+
+class FitScheduler(_PoolJobs):
+    ''' Fit spectra in a thread pool, or a process pool with processes=True.
+    At most max_in_flight fits are submitted to the pool, the others wait in
+    a queue. Results are emitted in the order the fits end, with the
+    template (toolbox HPData) given when the fit was submitted '''
+    # item, model, fit result, gauge position, template
+    fitted = pyqtSignal(object, object, object, float, object)
+    failed = pyqtSignal(object, str)    # item, error message
+
+    def __init__(self, max_workers=None, max_in_flight=None, processes=False, parent=None):
+        super().__init__(max_workers or os.cpu_count() or 1, processes, parent)
+        self.max_in_flight = max_in_flight or 2*self.max_workers
+        self._queue = []        # (item, template, func, args, kwargs) not submitted yet
+        self._running = []      # (item, model, template, future)
+        self._done = 0
+        self._total = 0
+
+    def _pending(self):
+        return [future for *_, future in self._running]
+
+    def is_running(self):
+        return bool(self._queue or self._running)
+
+    def submit(self, item, model, x, y, guess_peak=None, window=None, binning=1, 
+               template=None):
+        # arguments of fit_spectrum, item and template only come back with the result
+        self._enqueue(item, template, fit_spectrum, (model, x, y), 
+                      dict(guess_peak=guess_peak, window=window, binning=binning))
+
+    def submit_tracking(self, item, tracker, x, y, template=None):
+        # fit_tracking call of a FitTracker, the next spectrum of a sequence
+        # is submitted once this one is fitted and added to the tracker
+        self._enqueue(item, template, fit_tracking, *tracker.arguments(x, y))
+
+    def _enqueue(self, item, template, func, args, kwargs):
+        # the template is copied now, later changes of the toolbox do not apply
+        self._queue.append((item, deepcopy(template), func, args, kwargs))
+        self._total += 1
+        self._fill()
+        self.progress.emit(self._done, self._total)
+        self._timer.start()
+
+    def _fill(self):
+        while self._queue and len(self._running) < self.max_in_flight:
+            item, template, func, args, kwargs = self._queue.pop(0)
+            self._running.append((item, args[0], template,
+                                  self.executor.submit(func, *args, **kwargs)))
+
+    def _collect(self):
+        # slots may submit new fits while the results are emitted
+        running, done = [], []
+        for entry in self._running:
+            (done if entry[3].done() else running).append(entry)
+        self._running = running
+        for item, model, template, future in done:
+            self._done += 1
+            try:
+                res, best_x = future.result()
+            except Exception as e:
+                self.failed.emit(item, str(e))
+            else:
+                self.fitted.emit(item, model, res, best_x, template)
+            self.progress.emit(self._done, self._total)
+        self._fill()
+        if not self.is_running():
+            self._finish()
+
+    def _reset(self):
+        self._queue = []
+        self._running = []
+        self._done = self._total = 0
+
+
+class _LivePipelineWorker(QObject):
+    processed = pyqtSignal(object, object, object)
+    failed = pyqtSignal(str, str)
+
+    @pyqtSlot(str, object, object, bool, object, float)
+    def process(self, path, model, template, subtract_bg, window, t_ready):
+        timings = {}
+        t0 = time.perf_counter()
+        timings["wait"] = t0 - t_ready
+        try:
+            item = load_spectrum(path)
+            t1 = time.perf_counter()
+            timings["parse"] = t1 - t0
+
+            x, y = item.x, item.y
+            if subtract_bg:
+                item.bg = convex_hull_bg(x, y)
+                item.corrected_y = y - item.bg
+                y = item.corrected_y
+            t2 = time.perf_counter()
+            timings["bg"] = t2 - t1
+
+            item.fit_model = model
+            item.fit_result, best_x = fit_spectrum(model, x, y, window=window)
+            item.fit_window = item.fit_result["window"]
+            t3 = time.perf_counter()
+            timings["fit"] = t3 - t2
+
+            point = deepcopy(template)
+            point.x = best_x
+            point.file = item.name
+            point.calcP()
+            item.fit_toolbox_config = point
+            timings["pressure"] = time.perf_counter() - t3
+        except Exception as e:
+            self.failed.emit(path, str(e))
+            return
+        self.processed.emit(item, point, timings)
+
+
+class LivePipeline(QObject):
+    ''' Parse, background, fit and pressure for each new file, off the GUI thread.
+    Per-stage latencies (s) are kept in self.latencies '''
+    processed = pyqtSignal(object, object, object)  # MySpectrumItem, HPData, timings
+    failed = pyqtSignal(str, str)                   # path, error message
+    _requested = pyqtSignal(str, object, object, bool, object, float)
+
+    STAGES = ("wait", "parse", "bg", "fit", "pressure", "table", "total")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.latencies = []
+        self._thread = QThread(self)
+        self._worker = _LivePipelineWorker()
+        self._worker.moveToThread(self._thread)
+        self._requested.connect(self._worker.process)
+        self._worker.processed.connect(self.processed)
+        self._worker.failed.connect(self.failed)
+        self._thread.start()
+
+    def submit(self, path, model, template, subtract_bg=True, window=None):
+        # model, toolbox template and fit window are the ones at the time the file is ready
+        self._requested.emit(path, model, deepcopy(template), subtract_bg, window,
+                             time.perf_counter())
+
+    def record(self, timings):
+        timings["total"] = sum(timings[k] for k in self.STAGES[:-1] if k in timings)
+        self.latencies.append(timings)
+
+    def summary(self):
+        # mean and max latency of each stage
+        return {k: (np.mean([t[k] for t in self.latencies]), 
+                    np.max([t[k] for t in self.latencies]))
+                for k in self.STAGES if self.latencies and k in self.latencies[0]}
+
+    def shutdown(self):
+        self._thread.quit()
+        self._thread.wait()
+
+
+class DirectoryWatcher(QObject):
+    ''' Index of the spectrum files of a directory, refreshed on each change
+    notification and before latest_file answers '''
+    fileReady = pyqtSignal(str)     # path of a new file, closed by its writer
+
+    def __init__(self, extensions=('.asc',), settle_interval=300, parent=None):
+        super().__init__(parent)
+        self.extensions = extensions
+        self.directory = None
+        self.index = {}         # file name -> mtime
+        self.latest = None      # name of the most recent file
+        self._pending = {}      # new file name -> (size, mtime) at last check
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._rescan)
+        # a new file is ready once its size and mtime stop changing
+        self._timer = QTimer(self)
+        self._timer.setInterval(settle_interval)
+        self._timer.timeout.connect(self._check_pending)
+
+    def set_directory(self, directory):
+        if self.directory is not None:
+            self._watcher.removePath(self.directory)
+        self.directory = directory
+        self.index = {}
+        self.latest = None
+        self._pending = {}
+        self._timer.stop()
+        # the only full scan, then the index is kept up to date
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if self._accept(entry.name) and entry.is_file():
+                    self._add(entry.name, entry.stat().st_mtime)
+        self._watcher.addPath(directory)
+
+    def latest_file(self):
+        # files rewritten in place do not change the directory, the
+        # index is refreshed before answering
+        if self.directory is None:
+            return None
+        self._rescan(self.directory)
+        if self.latest is None:
+            return None
+        return os.path.join(self.directory, self.latest)
+
+    def _accept(self, name):
+        return name.lower().endswith(self.extensions)
+
+    def _add(self, name, mtime):
+        self.index[name] = mtime
+        if self.latest is None or mtime >= self.index[self.latest]:
+            self.latest = name
+
+    def _rescan(self, directory):
+        # one scandir per change (linear in the number of files): known names
+        # get their current mtime, so that a file replaced under the same name
+        # is seen, new names wait in _pending until they are written
+        try:
+            with os.scandir(directory) as entries:
+                entries = {e.name: e for e in entries if self._accept(e.name)}
+        except OSError:
+            return
+        for name in self.index.keys() - entries.keys():
+            del self.index[name]
+        for name, entry in entries.items():
+            if name in self.index:
+                try:
+                    self.index[name] = entry.stat().st_mtime
+                except OSError:     # removed meanwhile
+                    del self.index[name]
+            elif name not in self._pending:
+                self._pending[name] = None
+        self.latest = max(self.index, key=self.index.get, default=None)
+        if self._pending and not self._timer.isActive():
+            self._timer.start()
+
+    def _check_pending(self):
+        for name, previous in list(self._pending.items()):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:     # removed before being ready
+                del self._pending[name]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current == previous and st.st_size > 0:
+                del self._pending[name]
+                self._add(name, st.st_mtime)
+                self.fileReady.emit(path)
+            else:
+                self._pending[name] = current
+        if not self._pending:
+            self._timer.stop()
 
 
 class CustomFileListModel(QAbstractListModel):
@@ -101,6 +424,12 @@ class CustomFileListModel(QAbstractListModel):
         self.endInsertRows()
         self.itemAdded.emit()  # Emit signal to notify the view
 
+    def setItems(self, items):
+        # erases the previous content!
+        self.beginResetModel()
+        self.items = list(items)
+        self.endResetModel()
+
     def deleteItem(self, index):
         self.beginRemoveRows(QModelIndex(), index, index)
         del self.items[index]
@@ -108,212 +437,14 @@ class CustomFileListModel(QAbstractListModel):
         self.itemDeleted.emit()  # Emit signal to notify the view
 
 
-
-class HPCalibration():
-    ''' A general HP calibration object '''
-    def __init__(self, name, func, Tcor_name, 
-                    xname, xunit, x0default, xstep, color):
-        self.name = name
-        self.func = func
-        self.Tcor_name = Tcor_name
-        self.xname = xname
-        self.xunit = xunit
-        self.x0default = x0default
-        self.xstep = xstep  # x step in spinboxes using mousewheel
-        self.color = color  # color printed in calibration combobox
-
-    def __repr__(self):
-        return 'HPCalibration : ' + str( self.__dict__ )
-
-    def invfunc(self, p, *args, **kwargs):
-        res = minimize( lambda x: ( self.func(x, *args, **kwargs) - p )**2, 
-                                    x0=self.x0default, method='Powell', tol=1e-6)
-        
-        return res.x[0]
-
-
-class GaugeFitModel():
-    ''' A general pressure gauge fitting model object '''
-    def __init__(self, name, func,type, color):
-        self.name = name
-        self.func = func
-        self.type = type
-        self.color = color  # color printed in calibration combobox
-
-    def get_pinit(self, x, y, guess_peak=None):
-    
-        pinit = list()
-        
-        xbin = x[1] - x[0] # nm/px or cm-1/px
-        if guess_peak == None:
-            pk, prop = find_peaks(y - np.min(y), height = np.ptp(y)/2, width=0.1/xbin)
-            pk = pk[np.argsort(prop['peak_heights'])]
-            prop['peak_heights'].sort()
-            pinit.append( y[0] )
-            params = getfullargspec(self.func).args[1:]
-            if (len(params)-1)%3 == 0:
-                param_per_peak = 3
-                peak_number = (len(params)-1)//3
-                for i in range(peak_number):
-                    pinit.append( 0.5 )                         # height
-                    pinit.append( x[pk[i]]  )                   # position
-                    pinit.append( prop['widths'][i] * xbin )    # sigma
-                   #print(prop['widths'][i] * xbin)
-            elif (len(params)-1)%4 == 0:
-                param_per_peak = 4
-                peak_number = (len(params)-1)//4
-                for i in range(peak_number):
-                    pinit.append( 0.5 )                         # height
-                    pinit.append( x[pk[i]]  )                   # position
-                    pinit.append( prop['widths'][i] * xbin/2 ) # sigma
-                    pinit.append( prop['widths'][i] * xbin/2 ) # gamma
-        else:
-            pinit.append( y[0] )
-            params = getfullargspec(self.func).args[1:]
-            if (len(params)-1)%3 == 0:
-                param_per_peak = 3
-                peak_number = (len(params)-1)//3
-                for i in range(peak_number):
-                    pinit.append( 0.5 )             # height
-                    pinit.append( guess_peak -1.5*i ) # idiot trick for the 2nd peak
-                    pinit.append( 0.5 )    # sigma
-            elif (len(params)-1)%4 == 0:
-                param_per_peak = 4
-                peak_number = (len(params)-1)//4
-                for i in range(peak_number):
-                    pinit.append( 0.5 )             # height
-                    pinit.append( guess_peak -1.5*i ) # idiot trick for the 2nd peak
-                    pinit.append( 0.2 ) # sigma
-                    pinit.append( 0.2 ) # gamma
-        return pinit
-
-
-    def __repr__(self):
-        return 'GaugeFitModel : ' + str( self.__dict__ )
-    
-
-
-class HPData():
-
-    def __init__(self, Pm, P, x, T, x0, T0, calib, file):
-        super().__init__()
-
-        self.Pm = Pm
-        self.P = P
-        self.x = x
-        self.T = T
-        self.x0 = x0
-        self.T0 = T0
-        self.calib = calib
-        self.file = file
-
-    def __repr__(self):
-        return str(self.df)
-
-    def calcP(self):
-        self.P = self.calib.func(self.x, self.T, self.x0, self.T0)
-
-    def invcalcP(self):
-        self.x = self.calib.invfunc(self.P, self.T, self.x0, self.T0)
-
-    # SOMETHING TO RETRIEVE THE CALIB OBJECT BY ITS NAME ?
-
-    @property
-    def df(self):       
-        _df = pd.DataFrame({'Pm': self.Pm,
-                            'P' : self.P, 
-                            'x' : self.x,
-                            'T' : self.T,
-                            'x0': self.x0,
-                            'T0': self.T0,
-                            'calib': self.calib.name,
-                            'file' : self.file}, index=[0])
-        return _df
-
-
-
-class HPDataTable(QObject):
+class HPDataTable(QObject, HPDataList):
+    ''' HPDataList emitting changed for the table and plot windows '''
     
     changed = pyqtSignal()
 
     def __init__(self, df=None, calibrations=None):
-        super().__init__()  
-    
-        self.datalist = []
+        QObject.__init__(self)
+        HPDataList.__init__(self, df, calibrations)
 
-        if df is not None:
-            self.reconstruct_from_df(df, calibrations)
-
-    def __repr__(self):
-        return str( self.df )
-
-    def __getitem__(self, index):
-        return self.datalist[index]
-
-    def __setitem__(self, index, HPDataobj):
-        self.datalist[index] = HPDataobj
-        self.changed.emit()
-
-    def __len__(self):
-        return len(self.datalist)
-
-
-    def recalc_item_P(self, index):
-        # method implemented to emit change!
-        self.datalist[index].calcP()
+    def notify(self):
         self.changed.emit()
-
-    def reinvcalc_item_P(self, index):
-        self.datalist[index].invcalcP()
-        self.changed.emit()
-
-    def setitemval(self, item, attr, val):
-        if val != getattr(self.datalist[item],attr): 
-            setattr(self.datalist[item], attr, val)
-            self.changed.emit()
-
-    def add(self, buffer):
-        # NB:  deepcopy fails if HPData inherits from QObject !
-        # deepcopy absolutely necessary here
-        # Here I work with the HPData object
-        self.datalist.append( deepcopy(buffer) )
-        self.changed.emit()
-
-    def removelast(self):
-        # Here I work with the HPData object
-        self.datalist = self.datalist[:-1]
-        self.changed.emit()
-
-    def removespecific(self, index):
-        del self.datalist[index]
-        self.changed.emit()
-
-    def reconstruct_from_df(self, df, calibrations):
-        # erases the previous content!
-        self.datalist = []
-        for _, row in df.iterrows():
-            HPdi = HPData(Pm = row['Pm'],
-                          P  = row['P'], 
-                          x  = row['x'], 
-                          T  = row['T'], 
-                          x0 = row['x0'], 
-                          T0 = row['T0'],
-                          calib = calibrations[row['calib']], # retrieve calib
-                          file = row['file'])
-            self.datalist.append(HPdi)
-        self.changed.emit()
-
-    @property
-    def df(self):
-        # should be used only as a REPRESENTATION of HPDataTable
-        _df = pd.DataFrame(columns=['Pm','P','x','T','x0','T0','calib','file'])
-        for xi in self.datalist:
-            _df = pd.concat([_df, xi.df ], ignore_index=True)
-        return _df
-
-
-if __name__ == '__main__':
-    import os
-    f1 = os.path.dirname(__file__)+'/resources/Example_Ruby_3_header_footer.asc'
-    
-    print(customparse_file2data(f1))
\ No newline at end of file
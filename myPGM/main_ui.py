@@ -1,7 +1,7 @@
 import os
+import time
 import numpy as np
 from copy import deepcopy
-from scipy.optimize import curve_fit
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -21,6 +21,7 @@ from PyQt5.QtWidgets import (
     QStyle,
     QFormLayout,
     QSplitter,
+    QProgressDialog,
 )
 from PyQt5.QtCore import (
     QFileInfo,
@@ -33,7 +34,6 @@ from PyQt5.QtCore import (
 from PyQt5.QtGui import QColor, QIcon
 
 from scipy.ndimage import uniform_filter1d, gaussian_filter1d
-from scipy.spatial import ConvexHull
 from scipy.interpolate import InterpolatedUnivariateSpline
 
 from fit_models import *
@@ -93,6 +93,17 @@ class MainWindow(QMainWindow):
         # open_param_action.triggered.connect(self.toggle_params)
         # param_menu.addAction(open_param_action)
 
+        #####################################################################################
+        # #? Setup session menu
+        session_menu = menubar.addMenu("Session")
+
+        save_session_action = QAction("Save session", self)
+        load_session_action = QAction("Load session", self)
+        save_session_action.triggered.connect(self.save_session)
+        load_session_action.triggered.connect(self.load_session)
+        session_menu.addAction(save_session_action)
+        session_menu.addAction(load_session_action)
+
         #####################################################################################
         # #? Setup Theme switch menu
         theme_menu = menubar.addMenu("Theme")
@@ -104,6 +115,24 @@ class MainWindow(QMainWindow):
         theme_menu.addAction(dark_action)
         theme_menu.addAction(light_action)
         #####################################################################################
+        # #? Setup parsed spectra cache menu
+        cache_menu = menubar.addMenu("Cache")
+
+        self.cache_action = QAction("Cache parsed spectra", self)
+        self.cache_action.setCheckable(True)
+        self.cache_action.setChecked(helpers.spectrum_cache.enabled)
+        self.cache_action.toggled.connect(self.toggle_cache)
+        self.fit_cache_action = QAction("Keep fit results between sessions", self)
+        self.fit_cache_action.setCheckable(True)
+        self.fit_cache_action.setChecked(helpers.fit_cache.persistent)
+        self.fit_cache_action.toggled.connect(self.toggle_fit_cache)
+        clear_cache_action = QAction("Clear cache", self)
+        clear_cache_action.triggered.connect(helpers.spectrum_cache.clear)
+        clear_cache_action.triggered.connect(helpers.fit_cache.clear)
+        cache_menu.addAction(self.cache_action)
+        cache_menu.addAction(self.fit_cache_action)
+        cache_menu.addAction(clear_cache_action)
+        #####################################################################################
         # #? Exit button setup
         exit_menu = menubar.addMenu("Exit")
 
@@ -316,9 +345,37 @@ class MainWindow(QMainWindow):
         self.loadlatest_button.clicked.connect(self.load_latest_file)
         FileLoadLayout.addWidget(self.loadlatest_button, 1, 1)
 
+        self.watch_button = QPushButton("Watch directory", self)
+        pixmapi = getattr(QStyle, "SP_MediaPlay")
+        icon = self.style().standardIcon(pixmapi)
+        self.watch_button.setIcon(icon)
+        self.watch_button.setCheckable(True)
+        self.watch_button.clicked.connect(self.toggle_watch)
+        FileLoadLayout.addWidget(self.watch_button, 2, 0)
+
+        self.live_button = QPushButton("Live fit", self)
+        pixmapi = getattr(QStyle, "SP_MediaSeekForward")
+        icon = self.style().standardIcon(pixmapi)
+        self.live_button.setIcon(icon)
+        self.live_button.setCheckable(True)
+        self.live_button.clicked.connect(self.toggle_live)
+        FileLoadLayout.addWidget(self.live_button, 2, 1)
+
+        self.dir_watcher = helpers.DirectoryWatcher(parent=self)
+        self.watch_enabled = False
+
+        # its worker thread only runs while Live fit is on
+        self.live_pipeline = None
+
         FileManagementLayout.addLayout(FileLoadLayout)
 
         self.custom_model = helpers.CustomFileListModel()
+        self.importer = helpers.SpectrumImporter(parent=self)
+        self.importer.itemLoaded.connect(self.custom_model.addItem)
+        self.importer.failed.connect(self.import_failed)
+        self.importer.finished.connect(self.import_finished)
+        self.import_progress = None
+        self.import_errors = []
         self.list_widget = QListView(self)
         self.list_widget.setModel(self.custom_model)
         FileManagementLayout.addWidget(self.list_widget)
@@ -440,6 +497,21 @@ class MainWindow(QMainWindow):
         # self.fit_button.setFixedSize(QSize(50,50))
         FitButtonsBox.addWidget(self.fit_button)
 
+        self.fit_all_button = QPushButton("Fit all", self)
+        self.fit_all_button.setCheckable(True)
+        self.fit_all_button.setToolTip("Fit every loaded file, click again to cancel")
+        self.fit_all_button.clicked.connect(self.toggle_fit_all)
+        FitButtonsBox.addWidget(self.fit_all_button)
+
+        # fits run in a thread pool, results come back through fit_done
+        self.fit_scheduler = helpers.FitScheduler(parent=self)
+        self.fit_scheduler.fitted.connect(self.fit_done)
+        self.fit_scheduler.failed.connect(self.fit_failed)
+        self.fit_scheduler.progress.connect(self.fit_progress)
+        self.fit_scheduler.finished.connect(self.fit_all_finished)
+        self.fit_errors = []
+        self.tracking = None    # state of the running tracking fit, see track_fit
+
         self.click_fit_button = QPushButton("Click-to-fit", self)
         # self.click_fit_button.setStyleSheet("background-color : white")
         # self.click_fit_button.setIcon(QIcon(os.path.dirname(__file__)+'/resources/icons/click_to_fit.png'))
@@ -450,6 +522,21 @@ class MainWindow(QMainWindow):
         self.click_fit_enabled = False
         FitButtonsBox.addWidget(self.click_fit_button)
 
+        self.fit_window_button = QPushButton("Fit window", self)
+        self.fit_window_button.setCheckable(True)
+        self.fit_window_button.setToolTip("Fit only the range selected on the plot")
+        self.fit_window_button.clicked.connect(self.toggle_fit_window)
+        self.last_fit_window = None     # reused by the next spectra of a series
+        FitButtonsBox.addWidget(self.fit_window_button)
+
+        self.track_fit_button = QPushButton("Track fit", self)
+        self.track_fit_button.setCheckable(True)
+        self.track_fit_button.setToolTip("Fit the selected file and the next ones, "
+                                         "each fit starting from the previous one, "
+                                         "click again to cancel")
+        self.track_fit_button.clicked.connect(self.track_fit)
+        FitButtonsBox.addWidget(self.track_fit_button)
+
         FitOptionBox.addLayout(FitButtonsBox)
 
         self.fit_model_combo = QComboBox()
@@ -464,6 +551,17 @@ class MainWindow(QMainWindow):
         self.update_fit_model()
         FitOptionBox.addWidget(self.fit_model_combo)
 
+        BinningBox = QHBoxLayout()
+        BinningBox.addWidget(QLabel("Coarse binning:", self))
+        self.binning_factor = QDoubleSpinBox()
+        self.binning_factor.setDecimals(0)
+        self.binning_factor.setRange(1, 64)
+        self.binning_factor.setValue(1)
+        self.binning_factor.setToolTip("First fit the spectrum binned by this factor, "
+                                       "then refine at full resolution")
+        BinningBox.addWidget(self.binning_factor)
+        FitOptionBox.addLayout(BinningBox)
+
         InteractionBox.addLayout(FitOptionBox)
 
         FitBoxLayout.addLayout(InteractionBox)
@@ -486,8 +584,18 @@ class MainWindow(QMainWindow):
         self.data_bg_pen = pg.mkPen(color='darkviolet', width=3)
         self.data_bg_scatter = pg.ScatterPlotItem(symbol='s', size=8, brush='darkviolet')
         self.data_fit_line = pg.PlotDataItem(name='Fit',pen=self.data_fit_pen,)
+        # fitted curves are drawn on this many points of the visible range when finer than the data
+        self.fit_curve_points = 1000
+        # a tracked fit with a residual this many times the previous one is redone from a cold start
+        self.track_residual_factor = 3
+        self.data_widget.plotItem.vb.sigXRangeChanged.connect(self.fit_view_changed)
         self.data_bg_line = pg.PlotDataItem(name='Bg',pen=self.data_bg_pen)
         self.data_edge_marker = pg.InfiniteLine(pos=None, angle=90, pen=self.data_fit_pen, movable=False)
+        self.fit_window_region = pg.LinearRegionItem(orientation='vertical',
+                                                     pen=pg.mkPen(color='green'),
+                                                     movable=True,
+                                                     swapMode='sort')
+        self.fit_window_region.sigRegionChangeFinished.connect(self.fit_window_changed)
         
         self.data_widget.setMenuEnabled(False)
         self.data_scatter.scene().sigMouseClicked.connect(self.data_plot_click)
@@ -533,6 +641,7 @@ class MainWindow(QMainWindow):
 
         self.data.changed.connect(self.DataTableWindow.table_widget.updatetable)
         self.data.changed.connect(self.PvPmPlotWindow.updateplot)
+        self.DataTableWindow.referenceRequested.connect(self.apply_reference)
 
         # #####################################################################################
         # #? Create special startup config for debugging
@@ -548,12 +657,7 @@ class MainWindow(QMainWindow):
             for i, file in enumerate(example_files):
                 latest_file_path = os.path.dirname(__file__) + "/resources/" + file
 
-                file_info = QFileInfo(latest_file_path)
-                file_name = file_info.fileName()
-                list_item = helpers.MySpectrumItem(file_name, latest_file_path)
-
-                list_item.data = helpers.customparse_file2data(latest_file_path)
-                list_item.normalize_data()
+                list_item = helpers.load_spectrum(latest_file_path)
 
                 self.custom_model.addItem(list_item)
                 list_item.current_smoothing = self.smoothing_factor.value()
@@ -562,6 +666,10 @@ class MainWindow(QMainWindow):
     #####################################################################################
     # ? Main window methods
     def closeEvent(self, event):
+        self.importer.shutdown()
+        if self.live_pipeline is not None:
+            self.live_pipeline.shutdown()
+        self.fit_scheduler.shutdown()
         for window in QApplication.topLevelWidgets():
             window.close()
 
@@ -635,10 +743,58 @@ class MainWindow(QMainWindow):
             if current_spectrum.fit_result is not None:
                 self.plot_fit(current_spectrum)
 
+    def toggle_cache(self, checked):
+        helpers.spectrum_cache.enabled = checked
+
+    def toggle_fit_cache(self, checked):
+        helpers.fit_cache.persistent = checked
+
+    def save_session(self):
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "Save session", "", "myPGM session (*.npz);;All Files (*)"
+        )
+        if file_name:
+            if not file_name.endswith(".npz"):
+                file_name += ".npz"
+            try:
+                helpers.save_session(file_name, self.custom_model.items, self.data.datalist)
+            except (OSError, ValueError) as e:
+                msg = QMessageBox()
+                msg.setIcon(QMessageBox.Critical)
+                msg.setText(f"Session could not be saved:\n{e}")
+                msg.setWindowTitle("Session error")
+                msg.exec_()
+
+    def load_session(self):
+        file_name, _ = QFileDialog.getOpenFileName(
+            self, "Load session", "", "myPGM session (*.npz);;All Files (*)"
+        )
+        if file_name:
+            try:
+                items, datalist = helpers.load_session(
+                    file_name, self.models, self.calibrations
+                )
+            except (OSError, ValueError, KeyError) as e:
+                msg = QMessageBox()
+                msg.setIcon(QMessageBox.Critical)
+                msg.setText(f"Session could not be loaded:\n{e}")
+                msg.setWindowTitle("Session error")
+                msg.exec_()
+                return
+            # replaces the current files and table
+            self.custom_model.setItems(items)
+            self.current_selected_file_index = None
+            self.data.reset(datalist)
+
     def add_to_table(self):
         self.buffer.file = "No"
         self.data.add(self.buffer)
 
+    def apply_reference(self, rows):
+        # toolbox calibration and reference to table rows, pressures recomputed at once
+        self.data.set_reference(rows, calib=self.buffer.calib, x0=self.buffer.x0, 
+                                T0=self.buffer.T0, T=self.buffer.T)
+
     def removelast(self):
         if len(self.data) > 0:
             self.data.removelast()
@@ -651,6 +807,8 @@ class MainWindow(QMainWindow):
 
             try:
                 self.buffer.invcalcP()
+                if not np.isfinite(self.buffer.x):
+                    raise ValueError("no position for this pressure")
                 self.x_spinbox.setValue(self.buffer.x)
 
                 self.x_spinbox.setStyleSheet("background: #4a8542;")  # green
@@ -725,15 +883,41 @@ class MainWindow(QMainWindow):
 
         if file_dialog.exec_():
             selected_files = file_dialog.selectedFiles()
-            for file in selected_files:
-                file_info = QFileInfo(file)
-                file_name = file_info.fileName()
-                new_item = helpers.MySpectrumItem(file_name, file)
-
-                new_item.data = helpers.customparse_file2data(file)
-                new_item.normalize_data()
-                new_item.current_smoothing = 1
-                self.custom_model.addItem(new_item)
+            self.import_files(selected_files)
+
+    def import_files(self, files):
+        # files are parsed in worker processes, items are added in order
+        if self.import_progress is None:
+            self.import_progress = QProgressDialog(
+                "Importing files...", "Cancel", 0, len(files), self
+            )
+            self.import_progress.setWindowTitle("Import")
+            self.import_progress.setWindowModality(Qt.WindowModal)
+            self.import_progress.canceled.connect(self.importer.cancel)
+            self.importer.progress.connect(self.update_import_progress)
+        self.importer.start(files)
+
+    def update_import_progress(self, done, total):
+        if self.import_progress is not None:
+            self.import_progress.setMaximum(total)
+            self.import_progress.setValue(done)
+
+    def import_failed(self, path, error):
+        self.import_errors.append(f"{os.path.basename(path)}: {error}")
+
+    def import_finished(self):
+        if self.import_progress is not None:
+            self.importer.progress.disconnect(self.update_import_progress)
+            self.import_progress.canceled.disconnect(self.importer.cancel)
+            self.import_progress.close()
+            self.import_progress = None
+        if self.import_errors:
+            msg = QMessageBox()
+            msg.setIcon(QMessageBox.Critical)
+            msg.setText("Some files could not be loaded:\n" + "\n".join(self.import_errors))
+            msg.setWindowTitle("Import error")
+            self.import_errors = []
+            msg.exec_()
 
     @pyqtSlot()
     def delete_file(self):
@@ -750,28 +934,80 @@ class MainWindow(QMainWindow):
         if dir_name:
             self.dir_name = dir_name
             self.dir_label.setText(f"Selected directory: {dir_name}")
+            self.dir_watcher.set_directory(dir_name)
+
+    def toggle_watch(self, checked):
+        if checked and not hasattr(self, "dir_name"):
+            self.watch_button.setChecked(False)
+            msg = QMessageBox()
+            msg.setIcon(QMessageBox.Critical)
+            msg.setText("No directory selected.")
+            msg.setWindowTitle("Error")
+            msg.exec_()
+            return
+        # new files are appended to the list as soon as they are written
+        if checked:
+            self.dir_watcher.fileReady.connect(self.watched_file_ready)
+        elif self.watch_enabled:
+            self.dir_watcher.fileReady.disconnect(self.watched_file_ready)
+        self.watch_enabled = checked
+
+    def watched_file_ready(self, path):
+        if self.live_button.isChecked():
+            window = self.last_fit_window if self.fit_window_button.isChecked() else None
+            self.live_pipeline.submit(
+                path, self.models[self.fit_model_combo.currentText()], self.buffer,
+                window=window
+            )
+        else:
+            self.importer.start([path])
+
+    def toggle_live(self, checked):
+        # live mode: every new file is parsed, corrected, fitted and added to the table
+        if checked and not self.watch_enabled:
+            self.watch_button.setChecked(True)
+            self.toggle_watch(True)
+            if not self.watch_enabled:
+                self.live_button.setChecked(False)
+                return
+        if checked and self.live_pipeline is None:
+            self.live_pipeline = helpers.LivePipeline(parent=self)
+            self.live_pipeline.processed.connect(self.live_processed)
+            self.live_pipeline.failed.connect(self.live_failed)
+        elif not checked and self.live_pipeline is not None:
+            # the spectrum being processed is finished first
+            self.live_pipeline.shutdown()
+            self.live_pipeline.deleteLater()
+            self.live_pipeline = None
+
+    def live_processed(self, item, point, timings):
+        t0 = time.perf_counter()
+        self.custom_model.addItem(item)
+        point.Pm = self.buffer.Pm
+        self.data.add(point)
+        timings["table"] = time.perf_counter() - t0
+        if self.live_pipeline is None:
+            # switched off while this spectrum was processed
+            return
+        self.live_pipeline.record(timings)
+        self.statusBar().showMessage(
+            "Live: "
+            + " | ".join(
+                f"{k} {1e3 * timings[k]:.1f} ms" for k in helpers.LivePipeline.STAGES
+            )
+            + f" | {len(self.live_pipeline.latencies)} spectra"
+        )
+
+    def live_failed(self, path, error):
+        self.statusBar().showMessage(f"Live: {os.path.basename(path)} failed ({error})")
 
     @pyqtSlot()
     def load_latest_file(self):
         if hasattr(self, "dir_name"):
-            file_names = [
-                f
-                for f in os.listdir(self.dir_name)
-                if os.path.isfile(os.path.join(self.dir_name, f)) and ".asc" in f
-            ]
-            if file_names:
-                file_names.sort(
-                    key=lambda f: os.path.getmtime(os.path.join(self.dir_name, f))
-                )
-                latest_file_name = file_names[-1]
-                file = os.path.join(self.dir_name, latest_file_name)
-                file_info = QFileInfo(file)
-                file_name = file_info.fileName()
-                new_item = helpers.MySpectrumItem(file_name, file)
-
-                new_item.data = helpers.customparse_file2data(file)
-                new_item.normalize_data()
-                new_item.current_smoothing = 1
+            # the directory index is kept up to date by the watcher
+            file = self.dir_watcher.latest_file()
+            if file is not None:
+                new_item = helpers.load_spectrum(file)
 
                 self.custom_model.addItem(new_item)
             else:
@@ -896,30 +1132,20 @@ class MainWindow(QMainWindow):
             current_spectrum = self.custom_model.data(
                 self.current_selected_file_index, role=Qt.UserRole
             )
-            if hasattr(current_spectrum, "data"):
+            if current_spectrum.y is not None:
     # spectral data
                 self.data_widget.setLabel("bottom", f"{self.buffer.calib.xname} ({self.buffer.calib.xunit})")
                 self.data_widget.setLabel("left", 'Intensity')
 
-                if current_spectrum.corrected_data is None:
-                    x = current_spectrum.data[:, 0]
-                    y = current_spectrum.data[:, 1]
-                else:
-                    x = current_spectrum.corrected_data[:, 0]
-                    y = current_spectrum.corrected_data[:, 1]
+                x, y = current_spectrum.get_xy()
 
                 self.data_scatter.setData(x, y)
                 self.data_widget.autoRange()
 
-                # self.data_widget.addItem(pg.LinearRegionItem(values=(x[0]+(x[-1]-x[0])/3, x[0]+2*(x[-1]-x[0])/3),
-                # orientation='vertical',
-                # brush=None,
-                # pen=pg.mkPen(color='green'),
-                # hoverBrush=None,
-                # hoverPen=None,
-                # movable=True,
-                # swapMode='sort',
-                # ))
+                if self.fit_window_button.isChecked():
+                    if current_spectrum.fit_window is None:
+                        current_spectrum.fit_window = self.default_fit_window(x, y)
+                    self.show_fit_window(current_spectrum.fit_window)
 
     # derivative data
                 self.deriv_widget.setLabel("bottom", f"{self.buffer.calib.xname} ({self.buffer.calib.xunit})")
@@ -939,11 +1165,8 @@ class MainWindow(QMainWindow):
             )
             smooth_window = int(self.smoothing_factor.value() // 1)
             current_spectrum.current_smoothing = self.smoothing_factor.value()
-            current_spectrum.corrected_data = np.column_stack(
-                (
-                    current_spectrum.data[:, 0],
-                    uniform_filter1d(current_spectrum.data[:, 1], size=smooth_window),
-                )
+            current_spectrum.corrected_y = uniform_filter1d(
+                current_spectrum.y, size=smooth_window
             )
             self.plot_data()
             if current_spectrum.fit_result is not None:
@@ -969,61 +1192,207 @@ class MainWindow(QMainWindow):
             current_spectrum = self.custom_model.data(
                 self.current_selected_file_index, role=Qt.UserRole
             )
-            current_spectrum.fit_model = fit_mode
-
-            if current_spectrum.corrected_data is None:
-                x = current_spectrum.data[:, 0]
-                y = current_spectrum.data[:, 1]
+            self.submit_fit(current_spectrum, fit_mode)
+
+    def submit_fit(self, item, model, guess_peak=None):
+        x, y = item.get_xy()
+        self.fit_scheduler.submit(item, model, x, y, guess_peak=guess_peak, 
+                                  window=self.current_fit_window(item),
+                                  binning=int(self.binning_factor.value()),
+                                  template=self.buffer)
+
+    def toggle_fit_all(self, checked):
+        if not checked:
+            self.fit_scheduler.cancel()
+            return
+        if self.tracking is not None:
+            self.fit_all_button.setChecked(False)
+            return
+        fit_mode = self.models[self.fit_model_combo.currentText()]
+        for row in range(self.custom_model.rowCount()):
+            item = self.custom_model.data(self.custom_model.index(row), role=Qt.UserRole)
+            if self.fit_window_button.isChecked() and item.fit_window is None:
+                item.fit_window = self.last_fit_window
+            self.submit_fit(item, fit_mode)
+        if not self.fit_scheduler.is_running():
+            self.fit_all_button.setChecked(False)
+
+    def fit_done(self, item, model, res, best_x, template):
+        # toolbox values when the fit was submitted, with the pressure of the fitted position
+        config = template
+        config.x = best_x
+        config.calcP()
+        item.fit_toolbox_config = config
+        item.fit_model = model
+        item.fit_result = res
+        if self.current_item() is item:
+            self.x_spinbox.setValue(best_x)
+            self.plot_fit(item)
+        if self.tracking is not None and self.tracking["item"] is item:
+            self.track_fitted(res)
+
+    def fit_failed(self, item, error):
+        if self.tracking is not None and self.tracking["item"] is item:
+            # skipped, the next spectrum starts from the previous fits
+            self.tracking["errors"].append(f"{item.name}: {error}")
+            self.tracking["tracker"].skip()
+            self.track_next()
+            return
+        if self.fit_all_button.isChecked():
+            self.fit_errors.append(f"{item.name}: {error}")
+            return
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Critical)
+        msg.setText("Attempted fit couldn't converge.")
+        msg.setWindowTitle("Fit error")
+        msg.exec_()
+
+    def fit_progress(self, done, total):
+        if total > 1 and self.tracking is None:
+            self.statusBar().showMessage(f"Fitting: {done}/{total}")
+
+    def fit_all_finished(self):
+        if self.tracking is not None:
+            self.track_finished()
+            return
+        if self.fit_all_button.isChecked():
+            self.fit_all_button.setChecked(False)
+            message = "Fits done"
+            if self.fit_errors:
+                message += f", {len(self.fit_errors)} failed: " + "; ".join(self.fit_errors)
+            self.statusBar().showMessage(message)
+            self.fit_errors = []
+
+    def current_item(self):
+        if self.current_selected_file_index is None:
+            return None
+        return self.custom_model.data(self.current_selected_file_index, role=Qt.UserRole)
+
+    def track_fit(self, checked):
+        # pressure ramp: fit the files from the selected one to the end of the
+        # list in the fit scheduler, one at a time since each fit starts from
+        # the previous ones
+        if not checked:
+            if self.tracking is not None:
+                self.tracking["stopped"] = True
+                self.fit_scheduler.cancel()
+            if self.tracking is not None:   # nothing was running
+                self.track_finished()
+            return
+        if self.current_selected_file_index is None or self.fit_scheduler.is_running():
+            self.track_fit_button.setChecked(False)
+            return
+        fit_mode = self.models[self.fit_model_combo.currentText()]
+        rows = range(self.current_selected_file_index.row(), self.custom_model.rowCount())
+        items = [self.custom_model.data(self.custom_model.index(row), role=Qt.UserRole)
+                 for row in rows]
+        history = []
+        previous = self.custom_model.data(
+            self.custom_model.index(rows[0] - 1), role=Qt.UserRole) if rows[0] > 0 else None
+        if (previous is not None and previous.fit_model is fit_mode 
+                and previous.fit_result is not None):
+            history = [previous.fit_result["opti"]]
+
+        window = self.last_fit_window if self.fit_window_button.isChecked() else None
+        self.tracking = {
+            "tracker": helpers.FitTracker(fit_mode, history, window=window, 
+                                          residual_factor=self.track_residual_factor),
+            "items": items, "next": 0, "item": None, "errors": [], "stopped": False,
+            # toolbox values of the whole run
+            "template": deepcopy(self.buffer),
+        }
+        self.track_next()
+
+    def track_next(self):
+        tracking = self.tracking
+        if tracking["next"] == len(tracking["items"]):
+            # track_finished is called once the scheduler is done
+            return
+        item = tracking["items"][tracking["next"]]
+        tracking["next"] += 1
+        tracking["item"] = item
+        if tracking["tracker"].window is not None:
+            item.fit_window = tracking["tracker"].window
+        x, y = item.get_xy()
+        self.statusBar().showMessage(
+            f"Tracking: {tracking['next']}/{len(tracking['items'])}")
+        self.fit_scheduler.submit_tracking(item, tracking["tracker"], x, y, 
+                                           template=tracking["template"])
+
+    def track_fitted(self, res):
+        # fit_done already applied the result to the item
+        self.tracking["tracker"].add(res)
+        self.track_next()
+
+    def track_finished(self):
+        tracking, self.tracking = self.tracking, None
+        self.track_fit_button.setChecked(False)
+        tracker = tracking["tracker"]
+        report = tracker.report
+        message = f"Tracked {report['spectra']} spectra"
+        if tracking["stopped"]:
+            message = "Tracking stopped: " + message
+        if tracker.model.type == "peak":
+            message += (f": {report['nfev']} function evaluations, "
+                        f"{report['cold_starts']} cold start(s)")
+            cold_nfev = tracker.cold_nfev_estimate()
+            if cold_nfev is None:
+                message += " (no cold start, the cost without tracking is unknown)"
             else:
-                x = current_spectrum.corrected_data[:, 0]
-                y = current_spectrum.corrected_data[:, 1]
-            try:
-                res = self.do_fit(fit_mode, x, y)
-                current_spectrum.fit_toolbox_config = deepcopy(self.buffer)
-                current_spectrum.fit_result = res
-                self.plot_fit(current_spectrum)
-            except:
-                msg = QMessageBox()
-                msg.setIcon(QMessageBox.Critical)
-                msg.setText("Attempted fit couldn't converge.")
-                msg.setWindowTitle("Fit error")
-                msg.exec_()
-
-    def do_fit(self, model, x, y, guess_peak=None):
-        if model.type == "peak":
-            try:
-                popt, pcov = curve_fit(
-                    model.func, x, y, p0=model.get_pinit(x, y, guess_peak=guess_peak)
-                )
+                message += f" (about {cold_nfev:.0f} without tracking)"
+        if tracking["errors"]:
+            message += (f", {len(tracking['errors'])} failed: " 
+                        + "; ".join(tracking["errors"]))
+        self.statusBar().showMessage(message)
 
-                # for now we use the number of args..
-                if len(popt) < 7:  # Samarium
-                    best_x = popt[2]
-                elif len(popt) < 8:  # Ruby Gaussian
-                    best_x = np.max([popt[2], popt[5]])
-                else:  # Ruby Voigt
-                    best_x = np.max([popt[2], popt[6]])
+    def toggle_click_fit(self):
+        self.click_fit_enabled = not self.click_fit_enabled
 
-                self.x_spinbox.setValue(best_x)
-                return {"opti": popt, "cov": pcov}
+    def default_fit_window(self, x, y):
+        # window of the previous spectrum of the series, else around the peaks found
+        if self.last_fit_window is not None:
+            return self.last_fit_window
+        window = helpers.auto_fit_window(self.models[self.fit_model_combo.currentText()], x, y)
+        if window is None:
+            window = (x[0] + (x[-1] - x[0])/3, x[0] + 2*(x[-1] - x[0])/3)
+        return tuple(float(v) for v in window)
+
+    def show_fit_window(self, window):
+        self.fit_window_region.blockSignals(True)
+        self.fit_window_region.setRegion(window)
+        self.fit_window_region.blockSignals(False)
+        if self.fit_window_region not in self.data_widget.items():
+            self.data_widget.addItem(self.fit_window_region)
+
+    def toggle_fit_window(self, checked):
+        current_spectrum = None
+        if self.current_selected_file_index is not None:
+            current_spectrum = self.custom_model.data(
+                self.current_selected_file_index, role=Qt.UserRole
+            )
+        if checked:
+            if current_spectrum is not None and current_spectrum.y is not None:
+                if current_spectrum.fit_window is None:
+                    current_spectrum.fit_window = self.default_fit_window(*current_spectrum.get_xy())
+                self.last_fit_window = current_spectrum.fit_window
+                self.show_fit_window(current_spectrum.fit_window)
+        else:
+            self.data_widget.removeItem(self.fit_window_region)
+            self.last_fit_window = None
+            if current_spectrum is not None:
+                current_spectrum.fit_window = None
 
-            except RuntimeError:
-                msg = QMessageBox()
-                msg.setIcon(QMessageBox.Critical)
-                msg.setText("Attempted fit couldn't converge.")
-                msg.setWindowTitle("Fit error")
-                msg.exec_()
-                return
-            else:
-                return
-        elif model.type == "edge":
-            grad = np.gradient(y)
-            best_x = x[np.argmin(grad)]
-            self.x_spinbox.setValue(best_x)
-            return {"opti": best_x, "cov": None}
+    def current_fit_window(self, spectrum):
+        return spectrum.fit_window if self.fit_window_button.isChecked() else None
 
-    def toggle_click_fit(self):
-        self.click_fit_enabled = not self.click_fit_enabled
+    def fit_window_changed(self):
+        window = tuple(float(v) for v in self.fit_window_region.getRegion())
+        self.last_fit_window = window
+        if self.current_selected_file_index is not None:
+            current_spectrum = self.custom_model.data(
+                self.current_selected_file_index, role=Qt.UserRole
+            )
+            current_spectrum.fit_window = window
 
     def data_plot_click(self, event):
         if event.button() == Qt.RightButton or (
@@ -1089,12 +1458,7 @@ class MainWindow(QMainWindow):
                 )
                 current_spectrum.fit_model = fit_mode
 
-            if current_spectrum.corrected_data is None:
-                x = current_spectrum.data[:, 0]
-                y = current_spectrum.data[:, 1]
-            else:
-                x = current_spectrum.corrected_data[:, 0]
-                y = current_spectrum.corrected_data[:, 1]
+            x, y = current_spectrum.get_xy()
 
             if fit_mode.type == "edge":
                 best_x = x_click
@@ -1105,11 +1469,7 @@ class MainWindow(QMainWindow):
                 self.plot_fit(current_spectrum)
 
             elif fit_mode.type == "peak":
-                res = self.do_fit(fit_mode, x, y, guess_peak=x_click)
-                # print('done fit')
-                current_spectrum.fit_toolbox_config = deepcopy(self.buffer)
-                current_spectrum.fit_result = res
-                self.plot_fit(current_spectrum)
+                self.submit_fit(current_spectrum, fit_mode, guess_peak=x_click)
 
             else:
                 print("Click to fit not implemented")
@@ -1123,19 +1483,9 @@ class MainWindow(QMainWindow):
         self.data_widget.removeItem(self.data_fit_line)
 
         if my_spectrum.fit_result is not None:
-            if my_spectrum.corrected_data is None:
-                x = my_spectrum.data[:, 0]
-                y = my_spectrum.data[:, 1]
-            else:
-                x = my_spectrum.corrected_data[:, 0]
-                y = my_spectrum.corrected_data[:, 1]
-
             if my_spectrum.fit_model.type == "peak":
-                fitted = [
-                    my_spectrum.fit_model.func(wvl, *my_spectrum.fit_result["opti"])
-                    for wvl in x
-                ]
-                self.data_fit_line.setData(x, fitted)
+                self.data_fit_line.setData(*my_spectrum.fitted_curve(
+                    self.data_widget.plotItem.vb.viewRange()[0], self.fit_curve_points))
                 self.data_widget.addItem(self.data_fit_line)
                 self.data_widget.setTitle(f"Fitted pressure : {my_spectrum.fit_toolbox_config.P : > 10.2f} GPa",
                                            color=self.plot_label_color, size="16pt")
@@ -1155,6 +1505,15 @@ class MainWindow(QMainWindow):
             self.data_fit_line.setData([],[])
             self.data_widget.setTitle('Not fitted', color=self.plot_label_color, size="16pt")
 
+    def fit_view_changed(self):
+        # zooming refines the fitted curve on the visible range
+        item = self.current_item()
+        if (item is not None and item.fit_result is not None and item.fit_model is not None
+                and item.fit_model.type == "peak" 
+                and self.data_fit_line in self.data_widget.items()):
+            self.data_fit_line.setData(*item.fitted_curve(
+                self.data_widget.plotItem.vb.viewRange()[0], self.fit_curve_points))
+
     def toggle_PvPm(self):
         if self.DataTableWindow.isVisible() or self.PvPmPlotWindow.isVisible():
             self.DataTableWindow.hide()
@@ -1167,20 +1526,12 @@ class MainWindow(QMainWindow):
         current_spectrum = self.custom_model.data(
             self.current_selected_file_index, role=Qt.UserRole
         )
-        if current_spectrum.corrected_data is None:
-            x = current_spectrum.data[:, 0]
-            y = current_spectrum.data[:, 1]
-        else:
-            x = current_spectrum.corrected_data[:, 0]
-            y = current_spectrum.corrected_data[:, 1]
+        x, y = current_spectrum.get_xy()
 
-        v = ConvexHull(np.column_stack((x, y))).vertices
-        v = np.roll(v, -v.argmin())
-        anchors = v[: v.argmax()]
-        bg = np.interp(x, x[anchors], y[anchors])
+        bg = helpers.convex_hull_bg(x, y)
         corrected = y - bg
 
-        current_spectrum.corrected_data = np.column_stack((x, corrected))
+        current_spectrum.corrected_y = corrected
         self.plot_data()
 
     def toggle_ManualBg(self):
@@ -1217,12 +1568,7 @@ class MainWindow(QMainWindow):
         current_spectrum = self.custom_model.data(
             self.current_selected_file_index, role=Qt.UserRole
         )
-        if current_spectrum.corrected_data is None:
-            x = current_spectrum.data[:, 0]
-            y = current_spectrum.data[:, 1]
-        else:
-            x = current_spectrum.corrected_data[:, 0]
-            y = current_spectrum.corrected_data[:, 1]
+        x, y = current_spectrum.get_xy()
 
         temp = np.array(self.ManualBg_points)
         x_bg = temp[:, 0]
@@ -1246,21 +1592,16 @@ class MainWindow(QMainWindow):
         current_spectrum = self.custom_model.data(
             self.current_selected_file_index, role=Qt.UserRole
         )
-        if current_spectrum.corrected_data is None:
-            x = current_spectrum.data[:, 0]
-            y = current_spectrum.data[:, 1]
-        else:
-            x = current_spectrum.corrected_data[:, 0]
-            y = current_spectrum.corrected_data[:, 1]
+        x, y = current_spectrum.get_xy()
         corrected = y - current_spectrum.bg
-        current_spectrum.corrected_data = np.column_stack((x, corrected))
+        current_spectrum.corrected_y = corrected
         self.plot_data()
 
     def Reset_Bg(self):
         current_spectrum = self.custom_model.data(
             self.current_selected_file_index, role=Qt.UserRole
         )
-        current_spectrum.corrected_data = None
+        current_spectrum.corrected_y = None
         current_spectrum.bg = None
         self.plot_data()
 